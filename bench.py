@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018-2020 Elliot Nunn
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+HELP = '''Benchmark macresources on a generated resource fork
+
+Every stage is timed (best of --repeat runs) and then run once more
+under tracemalloc for its peak memory. The corpus is the same for the
+same --seed and --scale, so results can be compared across versions:
+
+    python3 bench.py --json base.json       # before
+    python3 bench.py --compare base.json    # after: exits 1 on a regression'''
+
+
+import argparse
+import binascii
+import io
+import itertools
+import json
+import platform
+import random
+import struct
+import sys
+import time
+import tracemalloc
+
+import macresources
+from macresources import greggybits, hqx, instacomp
+
+
+# (type, weight, data size range) -- roughly the mix of a System file or application
+TYPES = [
+    (b'STR ', 20, (2, 80)),
+    (b'STR#', 8, (20, 1200)),
+    (b'vers', 3, (12, 60)),
+    (b'ICN#', 8, (256, 256)),
+    (b'ics#', 6, (64, 64)),
+    (b'icl8', 6, (1024, 1024)),
+    (b'ics8', 4, (256, 256)),
+    (b'DITL', 8, (20, 600)),
+    (b'DLOG', 5, (24, 40)),
+    (b'ALRT', 3, (12, 16)),
+    (b'MENU', 5, (20, 300)),
+    (b'CNTL', 3, (20, 40)),
+    (b'WIND', 2, (24, 40)),
+    (b'KCHR', 1, (1000, 3000)),
+    (b'TEXT', 2, (100, 8000)),
+    (b'styl', 2, (20, 400)),
+    (b'FREF', 2, (7, 7)),
+    (b'BNDL', 1, (30, 100)),
+    (b'CODE', 6, 'code'),
+    (b'DRVR', 1, 'code'),
+    (b'PICT', 2, 'blob'),
+    (b'snd ', 2, 'blob'),
+]
+
+
+def code_payload(rng, size):
+    """68k-like code: mostly common opcode words, with some immediates and A-traps."""
+    words = []
+    while len(words) * 2 < size:
+        x = rng.random()
+        if x < 0.65:
+            # Skewed towards the start of the table, like real code
+            words.append(greggybits.TABLE[min(int(rng.expovariate(1 / 40)), 255)])
+        elif x < 0.75:
+            words.append(0xA000 | rng.randrange(0x1000)) # trap
+        else:
+            words.append(rng.randrange(0x10000))
+    return struct.pack('>%dH' % len(words), *words)[:size]
+
+
+def blob_payload(rng, size):
+    """Sampled sound or picture data: noise with runs of silence."""
+    out = bytearray()
+    while len(out) < size:
+        if rng.random() < 0.2:
+            out.extend(bytes([0x80]) * rng.randrange(16, 2048))
+        else:
+            out.extend(rng.randbytes(rng.randrange(256, 8192)))
+    return bytes(out[:size])
+
+
+def make_corpus(seed=0, scale=1.0):
+    """Get a deterministic list of realistic Resource objects."""
+
+    rng = random.Random(seed)
+    count = max(1, int(1500 * scale))
+
+    kinds, weights = [t[:1] + t[2:] for t in TYPES], [t[1] for t in TYPES]
+    resources = []
+    used = set()
+    while len(resources) < count:
+        rtype, sizes = rng.choices(kinds, weights)[0]
+
+        # Most IDs are a little above 128, a few are system IDs (negative) or anywhere
+        x = rng.random()
+        if x < 0.8:
+            rid = 128 + int(rng.expovariate(1 / 30))
+        elif x < 0.9:
+            rid = -16384 + rng.randrange(512)
+        else:
+            rid = rng.randrange(-32768, 32768)
+        if (rtype, rid) in used: continue
+        used.add((rtype, rid))
+
+        if sizes == 'code':
+            data = code_payload(rng, rng.randrange(1000, 12000))
+        elif sizes == 'blob':
+            data = blob_payload(rng, rng.choice([16, 32, 64, 256]) * 1024)
+        else:
+            data = rng.randbytes(rng.randint(*sizes))
+
+        name = None
+        if rng.random() < 0.3:
+            name = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz ABCDEFGHIJéü™') for i in range(rng.randrange(1, 24)))
+
+        attribs = rng.choice([0, 0, 0, 0x20, 0x40, 0x50, 0x58, 0x04])
+        resources.append(macresources.Resource(rtype, rid, name, attribs, data))
+
+    return resources
+
+
+class _KeepOpen(io.BytesIO):
+    def close(self): pass # BinHex closes its output file
+
+
+def binhex_encode(raw):
+    from macresources import binhex
+    finfo = binhex.FInfo()
+    finfo.Type, finfo.Creator = b'APPL', b'????'
+    out = _KeepOpen()
+    bh = binhex.BinHex(('Bench', finfo, 0, len(raw)), out)
+    bh.write_rsrc(raw)
+    bh.close()
+    return out.getvalue()
+
+
+def binhex_decode(hqx):
+    from macresources import binhex
+    hb = binhex.HexBin(io.BytesIO(hqx))
+    hb.read()
+    return hb.read_rsrc()
+
+
+def stages(corpus):
+    """Yield (name, function, input bytes, resource count) for each stage, in order, feeding each other.
+
+    A stage that cannot run has the reason as a string instead of a function.
+    """
+
+    data_len = sum(len(r) for r in corpus)
+    raw = macresources.make_file(corpus)
+    rez = macresources.make_rez_code(corpus)
+    code = [bytes(r) for r in corpus if r.type in (b'CODE', b'DRVR')]
+    code_len = sum(len(c) for c in code)
+
+    yield 'make_file', lambda: macresources.make_file(corpus), data_len, len(corpus)
+    yield 'parse_file', lambda: list(macresources.parse_file(raw)), len(raw), len(corpus)
+    yield 'parse_file lazy', lambda: list(macresources.parse_file(raw, lazy=True)), len(raw), len(corpus)
+    yield 'make_rez_code', lambda: macresources.make_rez_code(corpus), data_len, len(corpus)
+    yield 'make_rez_code ascii_clean', lambda: macresources.make_rez_code(corpus, ascii_clean=True), data_len, len(corpus)
+    yield 'parse_rez_code', lambda: list(macresources.parse_rez_code(rez)), len(rez), len(corpus)
+    yield 'parse_rez_stream', lambda: list(macresources.parse_rez_stream(io.BytesIO(rez))), len(rez), len(corpus)
+
+    yield 'greggybits.pack', lambda: [greggybits.pack(c) for c in code], code_len, len(code)
+    packed = [greggybits.pack(c) for c in code]
+    yield 'greggybits.unpack', lambda: [greggybits.unpack(p) for p in packed], code_len, len(code)
+
+    for level in sorted(instacomp.LEVELS):
+        yield 'instacomp.pack level %d' % level, lambda level=level: [instacomp.pack(c, level) for c in code], code_len, len(code)
+    pairs = [(c, instacomp.pack(c)) for c in code]
+    pairs = [(c, p) for c, p in pairs if p is not c] # those left unpacked are not InstaComp data
+    packed = [p for c, p in pairs]
+    yield 'instacomp.unpack', lambda: [instacomp.unpack(p) for p in packed], sum(len(c) for c, p in pairs), len(packed)
+
+    # The bundled hqx codecs, and binascii's where Python still has them (before 3.11)
+    rle = hqx.rlecode_hqx(raw)
+    encoded = hqx.b2a_hqx(rle) + b':'
+    for name, codec in (('hqx', hqx), ('binascii hqx', binascii)):
+        if not hasattr(codec, 'b2a_hqx'):
+            yield name + ' encode', 'binascii hqx unavailable', len(raw), len(corpus)
+            yield name + ' decode', 'binascii hqx unavailable', len(raw), len(corpus)
+            continue
+        yield name + ' encode', lambda codec=codec: codec.b2a_hqx(codec.rlecode_hqx(raw)), len(raw), len(corpus)
+        yield name + ' decode', lambda codec=codec: codec.rledecode_hqx(codec.a2b_hqx(encoded)[0]), len(raw), len(corpus)
+
+    yield 'binhex encode', lambda: binhex_encode(raw), len(raw), len(corpus)
+    try:
+        hexed = binhex_encode(raw)
+    except Exception as e:
+        yield 'binhex decode', 'encode failed: %s' % e, len(raw), len(corpus)
+    else:
+        yield 'binhex decode', lambda: binhex_decode(hexed), len(raw), len(corpus)
+
+
+def binhex_stages(sizes, seed=0):
+    """Yield stages for BinHex alone on one file of each size (in MB), to show that the speed does not fall with size."""
+
+    rng = random.Random(seed)
+    for mb in sizes:
+        raw = blob_payload(rng, int(mb * 1e6))
+        yield 'binhex encode %g MB' % mb, lambda raw=raw: binhex_encode(raw), len(raw), 1
+        try:
+            hexed = binhex_encode(raw)
+        except Exception as e:
+            hexed = None
+            yield 'binhex decode %g MB' % mb, 'encode failed: %s' % e, len(raw), 1
+        else:
+            yield 'binhex decode %g MB' % mb, lambda hexed=hexed: binhex_decode(hexed), len(raw), 1
+        del raw, hexed
+
+
+def measure(func, repeat, memory=True):
+    best = None
+    for i in range(repeat):
+        t = time.perf_counter()
+        func()
+        t = time.perf_counter() - t
+        if best is None or t < best: best = t
+
+    if not memory: return best, None
+
+    # Separately, because tracemalloc slows allocation-heavy code a lot
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return best, peak
+
+
+def run(args):
+    corpus = make_corpus(args.seed, args.scale)
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': args.seed,
+        'scale': args.scale,
+        'corpus': {'resources': len(corpus), 'bytes': sum(len(r) for r in corpus), 'types': len({r.type for r in corpus})},
+        'stages': {},
+    }
+
+    for name, func, nbytes, count in itertools.chain(stages(corpus), binhex_stages(args.binhex_sizes, args.seed)):
+        if args.only and not any(o in name for o in args.only): continue
+
+        result = {'bytes': nbytes, 'resources': count}
+        if isinstance(func, str):
+            result['skipped'] = func
+        else:
+            try:
+                seconds, peak = measure(func, args.repeat, args.memory)
+            except Exception as e:
+                result['skipped'] = '%s: %s' % (type(e).__name__, e)
+            else:
+                result.update(seconds=seconds, mb_per_s=nbytes / seconds / 1e6,
+                    resources_per_s=count / seconds, peak_bytes=peak)
+
+        results['stages'][name] = result
+        print_stage(name, result)
+
+    return results
+
+
+def print_stage(name, result):
+    if 'skipped' in result:
+        print('%-26s skipped (%s)' % (name, result['skipped']))
+    else:
+        peak = result['peak_bytes']
+        peak = ' %8.1f MB peak' % (peak / 1e6) if peak is not None else ''
+        print('%-26s %8.3f s %9.1f MB/s %10.0f res/s%s' % (name,
+            result['seconds'], result['mb_per_s'], result['resources_per_s'], peak))
+
+
+def compare(results, baseline, tolerance):
+    """Print each stage against the baseline, and return the names of the ones that regressed."""
+
+    print()
+    print('Compared with baseline (Python %s, seed %r, scale %r):' % (baseline.get('python'), baseline.get('seed'), baseline.get('scale')))
+    if (baseline.get('seed'), baseline.get('scale')) != (results['seed'], results['scale']):
+        print('warning: different corpus, comparison is not meaningful')
+
+    regressed = []
+    for name, new in results['stages'].items():
+        old = baseline['stages'].get(name)
+        if old is None or 'skipped' in old or 'skipped' in new:
+            print('%-26s no comparison' % name)
+            continue
+
+        speed = new['mb_per_s'] / old['mb_per_s']
+        line = '%-26s speed x%.2f' % (name, speed)
+        flags = []
+        if speed < 1 - tolerance: flags.append('SLOWER')
+
+        if new['peak_bytes'] is not None and old['peak_bytes'] is not None:
+            memory = new['peak_bytes'] / max(old['peak_bytes'], 1)
+            line += ', peak memory x%.2f' % memory
+            if memory > 1 + tolerance and new['peak_bytes'] - old['peak_bytes'] > 0x10000: flags.append('MORE MEMORY')
+
+        if flags: regressed.append(name)
+        print(line, *flags)
+
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=HELP, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--seed', type=int, default=0, help='corpus random seed')
+    parser.add_argument('--scale', type=float, default=1.0, help='corpus size multiplier (1 = 1500 resources, about 8 MB;\na resource fork cannot exceed 16 MB)')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage (best is kept)')
+    parser.add_argument('--only', action='append', metavar='STAGE', help='only run stages whose name contains this')
+    parser.add_argument('--binhex-sizes', type=lambda x: [float(mb) for mb in x.split(',')], default=[], metavar='MB,MB,...', help='also time BinHex alone on a file of each size')
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help='skip the (slow) tracemalloc runs')
+    parser.add_argument('--json', metavar='FILE', help='save results as JSON')
+    parser.add_argument('--compare', metavar='FILE', help='compare with JSON results from an earlier run')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='fractional slowdown or memory growth to flag (default 0.1)')
+    args = parser.parse_args(argv)
+
+    results = run(args)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1 +1,2 @@
-from .main import parse_rez_code, parse_file, make_rez_code, make_file, Resource
+from .main import parse_rez_code, parse_rez_stream, validate_rez_code, parse_file, make_rez_code, iter_rez_code, write_rez_code, make_file, write_file, Resource, ResourceView, ResourceFork
+from .cache import RenderCache, DecompressCache
@@ -13,19 +13,23 @@ hexbin(inputfilename, outputfilename)
 # XXXX Note: currently, textfiles appear in mac-form on all platforms.
 # We seem to lack a simple character-translate in python.
 # (we should probably use ISO-Latin-1 on all but the mac platform).
-# XXXX The simple routines are too simple: they expect to hold the complete
-# files in-core. Should be fixed.
 # XXXX It would be nice to handle AppleDouble format on unix
 # (for servers serving macs).
-# XXXX I don't understand what happens when you get 0x90 times the same byte on
-# input. The resulting code (xx 90 90) would appear to be interpreted as an
-# escaped *value* of 0x90. All coders I've seen appear to ignore this nicety...
 #
 import io
+import mmap
 import os
+import re
 import struct
 import binascii
 
+from . import stats
+
+try:
+    from binascii import b2a_hqx, a2b_hqx, rlecode_hqx, rledecode_hqx
+except ImportError: # removed in Python 3.11
+    from .hqx import b2a_hqx, a2b_hqx, rlecode_hqx, rledecode_hqx
+
 __all__ = ["binhex","hexbin","Error"]
 
 class Error(Exception):
@@ -76,40 +80,48 @@ class openrsrc:
     def close(self):
         pass
 
+# The engines keep their buffers in bytearrays, which grow in place and
+# lose their heads cheaply, so that time is linear in the size of the file.
+
 class _Hqxcoderengine:
     """Write data to the coder in 3-byte chunks"""
 
     def __init__(self, ofp):
         self.ofp = ofp
-        self.data = b''
-        self.hqxdata = b''
+        self.data = bytearray() # under 3 bytes left over
+        self.hqxdata = bytearray() # under a line left over
         self.linelen = LINELEN - 1
 
     def write(self, data):
-        self.data = self.data + data
-        datalen = len(self.data)
-        todo = (datalen // 3) * 3
-        data = self.data[:todo]
-        self.data = self.data[todo:]
-        if not data:
+        self.data += data
+        todo = (len(self.data) // 3) * 3
+        if not todo:
             return
-        self.hqxdata = self.hqxdata + binascii.b2a_hqx(data)
+        self.hqxdata += b2a_hqx(self.data[:todo])
+        del self.data[:todo]
         self._flush(0)
 
     def _flush(self, force):
+        # All the whole lines in one write
+        hqx = self.hqxdata
         first = 0
-        while first <= len(self.hqxdata) - self.linelen:
-            last = first + self.linelen
-            self.ofp.write(self.hqxdata[first:last] + b'\n')
+        lines = []
+        if len(hqx) >= self.linelen:
+            lines.append(hqx[:self.linelen])
+            first = self.linelen
             self.linelen = LINELEN
-            first = last
-        self.hqxdata = self.hqxdata[first:]
+            while first + LINELEN <= len(hqx):
+                lines.append(hqx[first:first+LINELEN])
+                first += LINELEN
+            lines.append(b'')
+            self.ofp.write(b'\n'.join(lines))
+        del hqx[:first]
         if force:
-            self.ofp.write(self.hqxdata + b':\n')
+            self.ofp.write(hqx + b':\n')
 
     def close(self):
         if self.data:
-            self.hqxdata = self.hqxdata + binascii.b2a_hqx(self.data)
+            self.hqxdata += b2a_hqx(self.data)
         self._flush(1)
         self.ofp.close()
         del self.ofp
@@ -119,19 +131,19 @@ class _Rlecoderengine:
 
     def __init__(self, ofp):
         self.ofp = ofp
-        self.data = b''
+        self.data = bytearray()
 
     def write(self, data):
-        self.data = self.data + data
+        self.data += data
         if len(self.data) < REASONABLY_LARGE:
             return
-        rledata = binascii.rlecode_hqx(self.data)
+        rledata = rlecode_hqx(self.data)
         self.ofp.write(rledata)
-        self.data = b''
+        self.data.clear()
 
     def close(self):
         if self.data:
-            rledata = binascii.rlecode_hqx(self.data)
+            rledata = rlecode_hqx(self.data)
             self.ofp.write(rledata)
         self.ofp.close()
         del self.ofp
@@ -193,6 +205,7 @@ class BinHex:
         self.ofp.write(struct.pack(fmt, self.crc))
         self.crc = 0
 
+    @stats.instrument('binhex.write', data=1)
     def write(self, data):
         if self.state != _DID_HEADER:
             raise Error('Writing data at the wrong time')
@@ -205,6 +218,7 @@ class BinHex:
         self._writecrc()
         self.state = _DID_DATA
 
+    @stats.instrument('binhex.write_rsrc', data=1)
     def write_rsrc(self, data):
         if self.state < _DID_DATA:
             self.close_data()
@@ -260,7 +274,7 @@ class _Hqxdecoderengine:
 
     def read(self, totalwtd):
         """Read at least wtd bytes (or until EOF)"""
-        decdata = b''
+        decdata = bytearray()
         wtd = totalwtd
         #
         # The loop here is convoluted, since we don't really now how
@@ -268,23 +282,29 @@ class _Hqxdecoderengine:
         while wtd > 0:
             if self.eof: return decdata
             wtd = ((wtd + 2) // 3) * 4
-            data = self.ifp.read(wtd)
+            data = bytearray(self.ifp.read(wtd))
             #
             # Next problem: there may not be a complete number of
-            # bytes in what we pass to a2b. Solve by yet another
-            # loop.
+            # bytes in what we pass to a2b. Count the characters that
+            # are not newlines, and read up to a multiple of 4 (or the
+            # final colon) before decoding once.
             #
-            while True:
-                try:
-                    decdatacur, self.eof = binascii.a2b_hqx(data)
-                    break
-                except binascii.Incomplete:
-                    pass
-                newdata = self.ifp.read(1)
-                if not newdata:
-                    raise Error('Premature EOF on binhex file')
-                data = data + newdata
-            decdata = decdata + decdatacur
+            if b':' not in data:
+                short = -(len(data) - data.count(b'\n') - data.count(b'\r')) % 4
+                while short:
+                    newdata = self.ifp.read(1)
+                    if not newdata:
+                        raise Error('Premature EOF on binhex file')
+                    data += newdata
+                    if newdata == b':':
+                        break
+                    if newdata not in b'\r\n':
+                        short -= 1
+            try:
+                decdatacur, self.eof = a2b_hqx(data)
+            except binascii.Incomplete:
+                raise Error('Premature EOF on binhex file')
+            decdata += decdatacur
             wtd = totalwtd - len(decdata)
             if not decdata and not self.eof:
                 raise Error('Premature EOF on binhex file')
@@ -293,64 +313,109 @@ class _Hqxdecoderengine:
     def close(self):
         self.ifp.close()
 
+class _Hqxbufferengine:
+    """Read data decoded from a buffer, all at once"""
+
+    def __init__(self, view):
+        # a2b_hqx reads straight from the buffer and stops at the final colon
+        try:
+            self.data, done = a2b_hqx(view)
+        except binascii.Incomplete:
+            raise Error('Premature EOF on binhex file')
+        if not done:
+            raise Error('Premature EOF on binhex file') # no final colon
+        self.pos = 0
+        self.eof = 0
+
+    def read(self, wtd):
+        with memoryview(self.data) as view:
+            rv = view[self.pos:self.pos+wtd]
+        self.pos += len(rv)
+        if self.pos >= len(self.data):
+            self.eof = 1
+            self.data = b'' # the caller has the last of it
+        return rv
+
+    def close(self):
+        self.data = b''
+
 class _Rledecoderengine:
     """Read data via the RLE-coder"""
 
     def __init__(self, ifp):
         self.ifp = ifp
-        self.pre_buffer = b''
-        self.post_buffer = b''
+        self.pre_buffer = bytearray()
+        self.post_buffer = bytearray()
+        self.post_pos = 0 # read offset into post_buffer
         self.eof = 0
 
     def read(self, wtd):
-        if wtd > len(self.post_buffer):
-            self._fill(wtd - len(self.post_buffer))
-        rv = self.post_buffer[:wtd]
-        self.post_buffer = self.post_buffer[wtd:]
+        """Read wtd bytes (fewer only at EOF)"""
+        # Escapes shrink and a few bytes are held back, so one fill can fall short
+        while len(self.post_buffer) - self.post_pos < wtd and not (self.ifp.eof and not self.pre_buffer):
+            self._fill(wtd - (len(self.post_buffer) - self.post_pos))
+        with memoryview(self.post_buffer) as view:
+            rv = bytes(view[self.post_pos:self.post_pos+wtd])
+        self.post_pos += len(rv)
+        if self.post_pos * 2 >= len(self.post_buffer):
+            del self.post_buffer[:self.post_pos]
+            self.post_pos = 0
         return rv
 
     def _fill(self, wtd):
-        self.pre_buffer = self.pre_buffer + self.ifp.read(wtd + 4)
+        data = self.ifp.read(wtd + 4)
         if self.ifp.eof:
-            self.post_buffer = self.post_buffer + \
-                binascii.rledecode_hqx(self.pre_buffer)
-            self.pre_buffer = b''
+            if self.pre_buffer:
+                self.pre_buffer += data
+                data = self.pre_buffer
+            self.post_buffer += rledecode_hqx(data)
+            self.pre_buffer = bytearray()
             return
+        self.pre_buffer += data
 
         #
-        # Obfuscated code ahead. We have to take care that we don't
-        # end up with an orphaned RUNCHAR later on. So, we keep a couple
-        # of bytes in the buffer, depending on what the end of
-        # the buffer looks like:
-        # '\220\0\220' - Keep 3 bytes: repeated \220 (escaped as \220\0)
-        # '?\220' - Keep 2 bytes: repeated something-else
-        # '\220\0' - Escaped \220: Keep 2 bytes.
-        # '?\220?' - Complete repeat sequence: decode all
-        # otherwise: keep 1 byte.
+        # We have to take care that we don't end up with an orphaned
+        # RUNCHAR later on. So, we keep back the end of the buffer from the
+        # last place where decoding can start again: after a byte other
+        # than RUNCHAR (which always ends a code) and not at a repeat code
+        # (RUNCHAR and a count), which needs the byte before it. Looking
+        # only at the last few bytes cannot tell '?\220\220' (repeated
+        # 0x90 times) from an escaped \220.
         #
-        mark = len(self.pre_buffer)
-        if self.pre_buffer[-3:] == RUNCHAR + b'\0' + RUNCHAR:
-            mark = mark - 3
-        elif self.pre_buffer[-1:] == RUNCHAR:
-            mark = mark - 2
-        elif self.pre_buffer[-2:] == RUNCHAR + b'\0':
-            mark = mark - 2
-        elif self.pre_buffer[-2:-1] == RUNCHAR:
-            pass # Decode all
-        else:
-            mark = mark - 1
+        pre = self.pre_buffer
+        mark = len(pre) - 1
+        while mark > 0 and (pre[mark-1] == 0x90 or
+                (pre[mark] == 0x90 and (mark + 1 == len(pre) or pre[mark+1] != 0))):
+            mark -= 1
 
-        self.post_buffer = self.post_buffer + \
-            binascii.rledecode_hqx(self.pre_buffer[:mark])
-        self.pre_buffer = self.pre_buffer[mark:]
+        self.post_buffer += rledecode_hqx(self.pre_buffer[:mark])
+        del self.pre_buffer[:mark]
 
     def close(self):
         self.ifp.close()
 
 class HexBin:
+    """Decode BinHex from a file name, a file object, or a buffer such as
+    bytes or an mmap. Files named by path are mapped rather than read, and
+    buffers are decoded in place, without copying the hqx text."""
+
     def __init__(self, ifp):
         if isinstance(ifp, str):
-            ifp = io.open(ifp, 'rb')
+            with io.open(ifp, 'rb') as f:
+                if not os.fstat(f.fileno()).st_size:
+                    raise Error("No binhex data found") # and an empty file cannot be mapped
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    self._init_buffer(mapped)
+            return
+
+        try:
+            memoryview(ifp).release()
+        except TypeError:
+            pass # a file object
+        else:
+            self._init_buffer(ifp)
+            return
+
         #
         # Find initial colon.
         #
@@ -370,6 +435,18 @@ class HexBin:
         self.crc = 0
         self._readheader()
 
+    def _init_buffer(self, buf):
+        with memoryview(buf) as view:
+            # Find initial colon, in one search
+            colon = re.search(b':', view)
+            if colon is None:
+                raise Error("No binhex data found")
+            hqxifp = _Hqxbufferengine(view[colon.end():])
+
+        self.ifp = _Rledecoderengine(hqxifp)
+        self.crc = 0
+        self._readheader()
+
     def _read(self, len):
         data = self.ifp.read(len)
         self.crc = binascii.crc_hqx(data, self.crc)
@@ -405,6 +482,7 @@ class HexBin:
 
         self.state = _DID_HEADER
 
+    @stats.instrument('binhex.read')
     def read(self, *n):
         if self.state != _DID_HEADER:
             raise Error('Read data at wrong time')
@@ -413,9 +491,9 @@ class HexBin:
             n = min(n, self.dlen)
         else:
             n = self.dlen
-        rv = b''
-        while len(rv) < n:
-            rv = rv + self._read(n-len(rv))
+        rv = self._read(n)
+        if len(rv) < n:
+            raise Error('Premature EOF on binhex file')
         self.dlen = self.dlen - n
         return rv
 
@@ -427,6 +505,7 @@ class HexBin:
         self._checkcrc()
         self.state = _DID_DATA
 
+    @stats.instrument('binhex.read_rsrc')
     def read_rsrc(self, *n):
         if self.state == _DID_HEADER:
             self.close_data()
@@ -437,8 +516,11 @@ class HexBin:
             n = min(n, self.rlen)
         else:
             n = self.rlen
+        rv = self._read(n)
+        if len(rv) < n:
+            raise Error('Premature EOF on binhex file')
         self.rlen = self.rlen - n
-        return self._read(n)
+        return rv
 
     def close(self):
         if self.state is None:
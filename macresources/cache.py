@@ -0,0 +1,205 @@
+# Copyright (c) 2018-2020 Elliot Nunn
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import collections
+import hashlib
+import os
+from os import path
+
+
+class RenderCache:
+    """
+    Content-addressed cache of rendered Rez code, for passing to
+    make_rez_code and friends as `cache`. Each resource's code is keyed by
+    a digest of its type, ID, name, attributes and data, and of
+    `ascii_clean`.
+
+    Up to `max_bytes` of code is held in memory, evicting the least
+    recently used. If a `directory` is given, every block is also saved
+    there (without limit), so that later processes can share it.
+
+    The `hits`, `disk_hits` (a subset of hits), `misses` and `evictions`
+    counters show whether the cache pays off.
+    """
+
+    def __init__(self, max_bytes=0x4000000, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self._blocks = collections.OrderedDict() # key: code, least recently used first
+        self._size = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return '%s(%d blocks, %d bytes, hits=%d, disk_hits=%d, misses=%d, evictions=%d)' % (self.__class__.__name__,
+            len(self._blocks), self._size, self.hits, self.disk_hits, self.misses, self.evictions)
+
+    def __len__(self):
+        return len(self._blocks)
+
+    @staticmethod
+    def key(resource, ascii_clean):
+        """Get the hex digest that a resource's code is cached under."""
+        digest = hashlib.sha256()
+        digest.update(repr((resource.type, resource.id, resource.name, resource.attribs, len(resource), bool(ascii_clean))).encode('utf-8'))
+        digest.update(resource.data)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """Get cached code (bytes) by key, or None."""
+
+        try:
+            self._blocks.move_to_end(key)
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            return self._blocks[key]
+
+        if self.directory is not None:
+            try:
+                with open(self._path(key), 'rb') as f:
+                    code = f.read()
+            except FileNotFoundError:
+                pass
+            else:
+                self.hits += 1
+                self.disk_hits += 1
+                self._remember(key, code)
+                return code
+
+        self.misses += 1
+        return None
+
+    def put(self, key, code):
+        """Store rendered code (bytes) under a key."""
+
+        self._remember(key, code)
+
+        if self.directory is not None:
+            dest = self._path(key)
+            if not path.exists(dest):
+                os.makedirs(path.dirname(dest), exist_ok=True)
+                temp = '%s.%d.tmp' % (dest, os.getpid())
+                with open(temp, 'wb') as f:
+                    f.write(code)
+                os.replace(temp, dest) # atomic, so a reader never sees half a block
+
+    def _remember(self, key, code):
+        if len(code) > self.max_bytes: return
+
+        old = self._blocks.pop(key, None)
+        if old is not None: self._size -= len(old)
+
+        self._blocks[key] = code
+        self._size += len(code)
+
+        while self._size > self.max_bytes:
+            key, evicted = self._blocks.popitem(last=False)
+            self._size -= len(evicted)
+            self.evictions += 1
+
+    def clear(self):
+        """Forget everything held in memory (not on disk), and zero the counters."""
+        self._blocks.clear()
+        self._size = 0
+        self.hits = self.disk_hits = self.misses = self.evictions = 0
+
+
+class DecompressCache:
+    """
+    Content-addressed cache of decompressed resource data, for passing
+    to Resource.unpacked as `cache`. Up to `max_bytes` of decompressed
+    data is held in memory, evicting the least recently used.
+
+    The `hits`, `misses` and `evictions` counters show whether the cache
+    pays off.
+    """
+
+    def __init__(self, max_bytes=0x4000000):
+        self.max_bytes = max_bytes
+        self._blocks = collections.OrderedDict() # key: data, least recently used first
+        self._size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return '%s(%d blocks, %d bytes, hits=%d, misses=%d, evictions=%d)' % (self.__class__.__name__,
+            len(self._blocks), self._size, self.hits, self.misses, self.evictions)
+
+    def __len__(self):
+        return len(self._blocks)
+
+    @staticmethod
+    def key(resource):
+        """Get the digest that the decompressed form of a resource's data is cached under.
+
+        The digest is remembered on the resource until it is modified, so a hot
+        resource is hashed only once. Changes written through a memoryview of a
+        Resource are not noticed: assign its `data` afterwards.
+        """
+
+        digest = getattr(resource, '_packed_digest', None)
+        if digest is None:
+            digest = resource._packed_digest = hashlib.sha256(resource.data).digest()
+        return digest
+
+    def get(self, key):
+        """Get cached data (bytes) by key, or None."""
+
+        try:
+            self._blocks.move_to_end(key)
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return self._blocks[key]
+
+    def put(self, key, data):
+        """Store decompressed data (bytes) under a key."""
+
+        if len(data) > self.max_bytes: return
+
+        old = self._blocks.pop(key, None)
+        if old is not None: self._size -= len(old)
+
+        self._blocks[key] = data
+        self._size += len(data)
+
+        while self._size > self.max_bytes:
+            key, evicted = self._blocks.popitem(last=False)
+            self._size -= len(evicted)
+            self.evictions += 1
+
+    def clear(self):
+        """Forget everything, and zero the counters."""
+        self._blocks.clear()
+        self._size = 0
+        self.hits = self.misses = self.evictions = 0
@@ -0,0 +1,104 @@
+# Copyright (c) 2018-2020 Elliot Nunn
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+"""
+Decompression of compressed resources, whatever the algorithm.
+
+A compressed resource has attribute bit 0 set and starts with an
+extended header ('\\xA8\\x9Fer'), whose dcmp field names the 'dcmp'
+resource that System 7 would use to decompress it. UNPACKERS maps that
+number to a Python function taking the whole resource data:
+
+    2: greggybits.unpack
+    3: instacomp.unpack
+
+More can be added with register().
+"""
+
+
+import struct
+
+from . import greggybits, instacomp
+from .cache import DecompressCache
+
+
+MAGIC = b'\xA8\x9Fer'
+
+UNPACKERS = {
+    2: greggybits.unpack,
+    3: instacomp.unpack,
+}
+
+default_cache = DecompressCache()
+
+
+class UnknownDcmpError(ValueError):
+    pass
+
+
+def register(dcmp, unpacker):
+    """Decompress data with this dcmp number using unpacker(data)."""
+    UNPACKERS[dcmp] = unpacker
+
+
+def dcmp_number(data):
+    """Get the dcmp number from the header of compressed data, or None if
+    the data has no extended header."""
+
+    if len(data) < 18 or bytes(data[:4]) != MAGIC: return None
+    return struct.unpack_from('>H', data, 12)[0]
+
+
+def is_compressed(resource):
+    """Whether a resource has the compressed attribute and header."""
+    return bool(resource.attribs & 1) and dcmp_number(resource.data) is not None
+
+
+def unpack(data):
+    """Decompress data with the unpacker registered for its dcmp number."""
+
+    dcmp = dcmp_number(data)
+    unpacker = UNPACKERS.get(dcmp)
+    if unpacker is None:
+        raise UnknownDcmpError('no unpacker for dcmp %r' % dcmp)
+    return unpacker(data)
+
+
+def unpack_resource(resource, cache=None):
+    """Get the data of a resource, decompressed if it is compressed.
+
+    Decompressed data is returned as read-only bytes and kept in `cache`
+    (by default, default_cache) for the next call with the same data.
+    The data of an uncompressed resource is returned as it is.
+    """
+
+    if not is_compressed(resource):
+        return resource.data
+
+    if cache is None: cache = default_cache
+    key = cache.key(resource)
+
+    unpacked = cache.get(key)
+    if unpacked is None:
+        unpacked = bytes(unpack(resource.data))
+        cache.put(key, unpacked)
+    return unpacked
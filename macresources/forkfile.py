@@ -0,0 +1,91 @@
+# Copyright (c) 2018-2020 Elliot Nunn
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Whole resource forks in files, loaded and saved the way the command-line
+tools (rfx, greggybits --fork) do. The file name decides the format: a
+.rdump file holds Rez code, a .hqx file is BinHex, and any other file holds
+a raw resource fork (such as File.rsrc or File/..namedfork/rsrc).
+
+A BinHex file also holds a file name, Finder info and a data fork.
+load_fork keeps them in the ResourceFork's hqx_info attribute as
+(name, FInfo, data), for save_fork to write back.
+"""
+
+
+from os import path
+
+from .main import ResourceFork, make_file, write_file, write_rez_code
+
+
+def is_rez(the_path):
+    return path.splitext(the_path)[1].lower() == '.rdump'
+
+
+def is_hqx(the_path):
+    return path.splitext(the_path)[1].lower() == '.hqx'
+
+
+def load_fork(the_path):
+    """Read a whole fork from a file into a ResourceFork."""
+
+    if is_hqx(the_path):
+        from . import binhex
+        hb = binhex.HexBin(the_path) # maps the file rather than reading it
+        hqx_info = (hb.FName.decode('mac_roman'), hb.FInfo, hb.read())
+        resources = ResourceFork.from_file(hb.read_rsrc())
+        hb.close() # checks the last CRC
+        resources.hqx_info = hqx_info
+        return resources
+
+    with open(the_path, 'rb') as f:
+        raw = f.read()
+
+    if is_rez(the_path):
+        # Unchanged resources are copied through when saving
+        return ResourceFork.from_rez_code(raw, original_file=the_path, keep_source=True)
+    else:
+        return ResourceFork.from_file(raw)
+
+
+def save_fork(the_path, resources, hqx_info=None):
+    """Write resources to a file, in the format that load_fork reads from it.
+
+    For a .hqx file, `hqx_info` is the (name, FInfo, data) to write with
+    the resources, by default their own hqx_info attribute.
+    """
+
+    if is_hqx(the_path):
+        from . import binhex
+        if hqx_info is None: hqx_info = resources.hqx_info
+        name, finfo, data = hqx_info
+        rsrc = make_file(resources)
+        bh = binhex.BinHex((name, finfo, len(data), len(rsrc)), the_path)
+        bh.write(data)
+        bh.write_rsrc(rsrc)
+        bh.close()
+        return
+
+    with open(the_path, 'wb') as f:
+        if is_rez(the_path):
+            write_rez_code(f, resources, ascii_clean=True)
+        else:
+            write_file(f, resources)
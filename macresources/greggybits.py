@@ -19,8 +19,12 @@
 # SOFTWARE.
 
 
+import collections
 import struct
 
+from . import stats
+from .optional import numpy as _numpy
+
 
 class WrongFormatError(ValueError):
     pass
@@ -65,7 +69,8 @@ TABLE = (
 TABLE_DICT = {word: idx for (idx, word) in enumerate(TABLE)}
 
 
-def unpack(src, _calculate_slop=False):
+def _unpack_reference(src, _calculate_slop=False):
+    # The original decoder, one byte at a time: unpack falls back on it to report errors
     if len(src) < 18: raise WrongFormatError
 
     dst = bytearray()
@@ -133,10 +138,215 @@ def unpack(src, _calculate_slop=False):
     return(dst)
 
 
-def pack_with_flags(src, flags, _defer_slop=False):
+# The fast decoder splits each table of words into translation tables for the high and low bytes
+def _split_table(words):
+    hi = bytes(word >> 8 for word in words).ljust(256, b'\0')
+    lo = bytes(word & 0xFF for word in words).ljust(256, b'\0')
+    return hi, lo
+
+TABLE_HI, TABLE_LO = _split_table(TABLE)
+
+
+# In bitmapped mode, a mask byte is followed by 8 words: 1 byte (a table index) for each set bit, 2 for each clear bit
+def _group_plan(mask):
+    offsets = [] # offset of each word from the mask byte
+    k = 1
+    for bit in range(8):
+        offsets.append(k)
+        k += 1 if mask & (0x80 >> bit) else 2
+    return offsets, k
+
+_GROUP_LENGTH = [_group_plan(mask)[1] for mask in range(256)]
+
+
+# Without NumPy, each byte k of the input is expanded into a 4-byte record (byte k, byte k+1, table word at k)
+# so that a group of 8 words is a single struct read
+def _group_structs():
+    words = []
+    indices = []
+    for mask in range(256):
+        offsets, length = _group_plan(mask)
+        word_fmt = index_fmt = '>'
+        word_end = index_end = 0
+        for bit, k in enumerate(offsets):
+            is_table = mask & (0x80 >> bit)
+            target = 4 * k + (2 if is_table else 0)
+            word_fmt += '%dxH' % (target - word_end)
+            word_end = target + 2
+            if is_table:
+                index_fmt += '%dxB' % (4 * k - index_end)
+                index_end = 4 * k + 1
+        words.append(struct.Struct(word_fmt))
+        indices.append(struct.Struct(index_fmt) if mask else None)
+    return words, indices
+
+_GROUP_WORDS, _GROUP_INDICES = _group_structs()
+_EIGHT_WORDS = struct.Struct('>8H')
+
+# NumPy is worth importing for this much bitmapped data
+GREGGY_NUMPY_BYTES = 0x10000
+_numpy_plans = None
+
+
+def _unpack_tail(body, dst, pos, out, count, hi, lo, nEntries):
+    # Decode the last (partial) group of a bitmapped stream, one word at a time
+    mask = body[pos]; pos += 1
+    for i in range(count):
+        if mask & 0x80:
+            idx = body[pos]; pos += 1
+            if idx >= nEntries: raise IndexError
+            dst[out] = hi[idx]
+            dst[out+1] = lo[idx]
+        else:
+            dst[out] = body[pos]
+            dst[out+1] = body[pos+1]
+            pos += 2
+        mask <<= 1
+        out += 2
+    return pos
+
+
+def _unpack_bitmapped(body, dst, nWords, hi, lo, nEntries):
+    records = bytearray(4 * len(body))
+    records[0::4] = body
+    records[1:-4:4] = body[1:]
+    records[2::4] = body.translate(hi)
+    records[3::4] = body.translate(lo)
+
+    read_words = _GROUP_WORDS
+    read_indices = _GROUP_INDICES if nEntries < 256 else None
+    length = _GROUP_LENGTH
+    write = _EIGHT_WORDS.pack_into
+
+    pos = 0
+    for out in range(0, 16 * (nWords >> 3), 16):
+        mask = body[pos]
+        write(dst, out, *read_words[mask].unpack_from(records, 4 * pos))
+        if read_indices and mask and max(read_indices[mask].unpack_from(records, 4 * pos)) >= nEntries:
+            raise IndexError
+        pos += length[mask]
+
+    if nWords & 7:
+        pos = _unpack_tail(body, dst, pos, 16 * (nWords >> 3), nWords & 7, hi, lo, nEntries)
+    return pos
+
+
+def _unpack_bitmapped_numpy(np, body, dst, nWords, hi, lo, nEntries):
+    global _numpy_plans
+    if _numpy_plans is None:
+        plans = [_group_plan(mask)[0] for mask in range(256)]
+        bits = [[bool(mask & (0x80 >> bit)) for bit in range(8)] for mask in range(256)]
+        _numpy_plans = np.array(plans, np.intp), np.array(bits, np.bool_)
+    offsets, bits = _numpy_plans
+
+    # Only finding where each group starts is sequential
+    groups = nWords >> 3
+    starts = [0] * groups
+    length = _GROUP_LENGTH
+    pos = 0
+    for g in range(groups):
+        starts[g] = pos
+        pos += length[body[pos]]
+    if pos > len(body): raise IndexError
+
+    if groups:
+        src = np.frombuffer(body, np.uint8)
+        starts = np.array(starts, np.intp)
+        masks = src[starts]
+        where = starts[:, np.newaxis] + offsets[masks]
+        is_table = bits[masks]
+
+        first = src[where]
+        if nEntries < 256 and (first[is_table] >= nEntries).any(): raise IndexError
+        second = src[np.minimum(where + 1, len(src) - 1)]
+
+        table = (np.frombuffer(hi, np.uint8).astype(np.uint16) << 8) | np.frombuffer(lo, np.uint8)
+        words = np.frombuffer(dst, '>u2', 8 * groups)
+        words[:] = np.where(is_table, table[first], (first.astype(np.uint16) << 8) | second).reshape(-1)
+
+    if nWords & 7:
+        pos = _unpack_tail(body, dst, pos, 16 * groups, nWords & 7, hi, lo, nEntries)
+    return pos
+
+
+def _unpack_fast(src):
+    # Whole-buffer decoding, raising IndexError or struct.error on bad data like the reference decoder
+    if len(src) < 18: raise WrongFormatError
+
+    magic, hdrLen, vers, iscmp, unpackSize, _dcmp, _slop, tabSize, comprFlags = struct.unpack_from(">LHBBLHHBB", src)
+    if magic != 0xA89F6572 or hdrLen != 18 or vers != 9 or iscmp != 1 or _dcmp != 2:
+        raise WrongFormatError
+
+    pos = 18
+    if comprFlags & 1:
+        nEntries = tabSize + 1
+        hi, lo = _split_table(struct.unpack_from(">" + str(nEntries) + "H", src, pos))
+        pos += nEntries * 2
+    else:
+        nEntries = 256
+        hi, lo = TABLE_HI, TABLE_LO
+
+    body = bytes(src[pos:])
+    nWords = unpackSize >> 1
+    dst = bytearray(unpackSize)
+
+    if comprFlags & 2:
+        np = len(body) >= GREGGY_NUMPY_BYTES and _numpy()
+        if np:
+            pos = _unpack_bitmapped_numpy(np, body, dst, nWords, hi, lo, nEntries)
+        else:
+            pos = _unpack_bitmapped(body, dst, nWords, hi, lo, nEntries)
+    else:
+        indices = body[:nWords]
+        if len(indices) < nWords: raise IndexError
+        if nEntries < 256 and nWords and max(indices) >= nEntries: raise IndexError
+        dst[0:2*nWords:2] = indices.translate(hi)
+        dst[1:2*nWords:2] = indices.translate(lo)
+        pos = nWords
+
+    if unpackSize & 1: # have a got an extra byte at the end?
+        dst[-1] = body[pos]
+        pos += 1
+    if pos > len(body): raise IndexError
+
+    return dst
+
+
+@stats.instrument('greggybits.unpack', data=0)
+def unpack(src, _calculate_slop=False):
+    if _calculate_slop:
+        return _unpack_reference(src, _calculate_slop=True)
+
+    try:
+        return _unpack_fast(src)
+    except (IndexError, struct.error):
+        return _unpack_reference(src) # to raise the same error
+
+
+def _count_words(src):
     nWords = len(src) >> 1
     inWords = struct.unpack(">" + str(nWords) + "H", src[:nWords*2])
+    return inWords, collections.Counter(inWords)
+
+
+def _rank_words(wordsCounts):
+    # Most frequent first, as the Apple compressor orders its table
+    return sorted(wordsCounts, reverse=True, key=lambda word: (wordsCounts[word], word))
+
 
+def _custom_table(ranked, wordsCounts, flags):
+    if len(ranked) > 256:
+        # The table has 8-bit indices. The Apple compressor short circuits inappropriately in this case.
+        return ranked[:256]
+    elif flags & 2:
+        # If we are able to encode words not in the table, then save space
+        # by removing remove rarely used entries from the table
+        return [word for word in ranked if wordsCounts[word] > 2]
+    else:
+        return ranked
+
+
+def _encode(src, flags, inWords, wordsCounts, ranked=None):
     dst = bytearray(b'\xA8\x9Fer')
     dst.extend(struct.pack('>HBBLH', 0x12, 9, 1, len(src), 2)) # magic, hdrlen, 9=gregg, 1=compressed, size, 2=dcmp
     dst.extend(bytes(4)) # to fill in later
@@ -145,18 +355,8 @@ def pack_with_flags(src, flags, _defer_slop=False):
     # Create a custom lookup table instead of the one at the beginning of the file
     LUT = TABLE_DICT
     if flags & 1:
-        import collections
-        wordsCounts = collections.Counter(inWords)
-        customTab = sorted(wordsCounts, reverse=True, key=lambda word: (wordsCounts[word], word))
-
-        if len(customTab) > 256:
-            # The table has 8-bit indices. The Apple compressor short circuits inappropriately in this case.
-            del customTab[256:]
-        elif flags & 2:
-            # If we are able to encode words not in the table, then save space
-            # by removing remove rarely used entries from the table
-            while customTab and wordsCounts[customTab[-1]] <= 2:
-                del customTab[-1]
+        if ranked is None: ranked = _rank_words(wordsCounts)
+        customTab = _custom_table(ranked, wordsCounts, flags)
 
         # Put the table after the header
         dst[16] = len(customTab) - 1
@@ -183,37 +383,217 @@ def pack_with_flags(src, flags, _defer_slop=False):
 
     else:
         # Table lookups only
-        dst.extend(LUT[word] for word in inWords) # triggers https://bugs.python.org/issue37417
+        dst.extend(bytes(map(LUT.__getitem__, inWords)))
 
     if len(src) & 1: # copy over last byte in the case of odd length
         dst.append(src[-1])
 
+    return dst
+
+
+_POPCOUNT = bytes(bin(mask).count('1') for mask in range(256))
+
+def _slop_from_bitmaps(src):
+    """Get the header's slop value for packed data: how far the unread
+    input ever runs ahead of the output still to come. This is worked out
+    from the bitmaps alone, without unpacking.
+    """
+
+    unpackSize, tabSize, comprFlags = struct.unpack_from(">8xL4xBB", src)
+    pos = 18
+    if comprFlags & 1: pos += 2 * (tabSize + 1)
+
+    ahead = len(src) - pos - unpackSize # before the first word
+    nWords = unpackSize >> 1
+
+    if not comprFlags & 2:
+        return max(0, ahead + nWords) # each word gains a byte, so the end is worst
+
+    # Each group of words costs a mask byte and gains a byte per table word
+    level = lowest = 0
+    for word in range(0, nWords, 8):
+        count = min(8, nWords - word)
+        tableWords = _POPCOUNT[src[pos] >> (8 - count)]
+        level += 1 - tableWords
+        if level < lowest: lowest = level
+        pos += 1 + 2 * count - tableWords
+
+    return max(0, ahead - lowest)
+
+
+def pack_with_flags(src, flags, _defer_slop=False):
+    inWords, wordsCounts = _count_words(src)
+    dst = _encode(src, flags, inWords, wordsCounts)
+
     if not _defer_slop:
-        slop = unpack(dst, _calculate_slop=True)
-        struct.pack_into('>H', dst, 14, slop)
+        struct.pack_into('>H', dst, 14, _slop_from_bitmaps(dst))
 
     return dst
 
 
+def _plan(src, wordsCounts, ranked):
+    """Get the exact packed size for each usable value of flags, without packing."""
+
+    nWords = len(src) >> 1
+    overhead = 18 + (len(src) & 1)
+    masks = (nWords + 7) >> 3
+
+    sizes = {}
+
+    staticHits = sum(count for word, count in wordsCounts.items() if word in TABLE_DICT)
+    if staticHits == nWords: # every word must be in the table
+        sizes[0] = overhead + nWords
+
+    if len(ranked) <= 256: # every word must fit in the table
+        sizes[1] = overhead + 2 * len(ranked) + nWords
+
+    # Each word not in the table costs a second byte
+    sizes[2] = overhead + masks + 2 * nWords - staticHits
+
+    customTab = _custom_table(ranked, wordsCounts, 3)
+    if customTab: # an empty table cannot be expressed
+        customHits = sum(wordsCounts[word] for word in customTab)
+        sizes[3] = overhead + 2 * len(customTab) + masks + 2 * nWords - customHits
+
+    return sizes
+
+
+@stats.instrument('greggybits.pack', data=0)
 def pack(src):
     if len(src) < 18: return src
 
-    bestCompress = src
+    inWords, wordsCounts = _count_words(src)
+    ranked = _rank_words(wordsCounts)
+
+    # Only the smallest mode gets encoded (the first of equals)
+    bestFlags = None
     bestSize = len(src)
-    for flags in (0, 1, 2, 3):
-        try:
-            thisCompress = pack_with_flags(src, flags, _defer_slop=True)
-        except:
-            continue
-
-        thisSize = len(thisCompress)
-        # thisSize += struct.unpack_from('>H', thisCompress, 14)[0]
+    for flags, thisSize in sorted(_plan(src, wordsCounts, ranked).items()):
         if thisSize < bestSize:
-            bestCompress = thisCompress
+            bestFlags = flags
             bestSize = thisSize
 
-    if bestCompress is not src:
-        slop = unpack(bestCompress, _calculate_slop=True)
-        struct.pack_into('>H', bestCompress, 14, slop)
+    if bestFlags is None: return src
+
+    bestCompress = _encode(src, bestFlags, inWords, wordsCounts, ranked)
+    struct.pack_into('>H', bestCompress, 14, _slop_from_bitmaps(bestCompress))
 
     return bestCompress
+
+
+# Whole forks are (un)packed on a pool of worker processes, one resource per job
+
+def _is_compressed(data):
+    # The same test that rfx uses to set the compressed attribute
+    return data.startswith(b'\xA8\x9F\x65\x72') and len(data) >= 6 and len(data) >= int.from_bytes(data[4:6], 'big')
+
+
+def _map(func, items, workers):
+    if workers is None or workers == 1:
+        return [func(item) for item in items]
+
+    import concurrent.futures
+    import os
+
+    chunksize = max(1, len(items) // (4 * (workers or os.cpu_count() or 1)))
+    with concurrent.futures.ProcessPoolExecutor(workers or None) as pool:
+        return list(pool.map(func, items, chunksize=chunksize))
+
+
+def _pack_job(data):
+    return bytes(pack(data))
+
+
+def _unpack_job(data):
+    try:
+        return bytes(unpack(data)), 'unpacked'
+    except WrongFormatError:
+        return None, 'other format'
+    except Exception:
+        return None, 'failed'
+
+
+def _verify_job(packed):
+    try:
+        unpacked = unpack(packed)
+    except WrongFormatError:
+        return 'other format'
+    except Exception:
+        return 'failed'
+
+    repacked = pack(unpacked)
+    if repacked == packed:
+        return 'good'
+    elif repacked[17] != packed[17]:
+        return 'wrong mode'
+    elif repacked[:14] == packed[:14] and repacked[16:] == packed[16:]:
+        return 'sloppy'
+    else:
+        return 'other'
+
+
+def _changed(resource, data):
+    resource.data = data
+    resource.attribs = (resource.attribs & ~1) | int(_is_compressed(data))
+
+
+def pack_resources(resources, workers=None):
+    """Compress every resource that is not compressed already, in place,
+    and set the compressed attribute of those that shrink.
+
+    Resources are packed on a pool of `workers` processes (0 meaning one
+    per CPU). Returns a collections.Counter of outcomes, and of the total
+    'bytes_in' and 'bytes_out'.
+    """
+
+    report = collections.Counter()
+    todo = []
+    for r in resources:
+        if r.startswith(b'\xA8\x9Fer'):
+            report['skipped'] += 1
+        else:
+            todo.append(r)
+
+    for r, packed in zip(todo, _map(_pack_job, [bytes(r) for r in todo], workers)):
+        report['bytes_in'] += len(r)
+        if len(packed) < len(r):
+            _changed(r, packed)
+            report['packed'] += 1
+        else:
+            report['incompressible'] += 1
+        report['bytes_out'] += len(r)
+
+    return report
+
+
+def unpack_resources(resources, workers=None):
+    """Decompress every GreggyBits resource, in place, and clear the
+    compressed attribute. Works like pack_resources."""
+
+    report = collections.Counter()
+    todo = []
+    for r in resources:
+        if r.startswith(b'\xA8\x9Fer'):
+            todo.append(r)
+        else:
+            report['skipped'] += 1
+
+    for r, (unpacked, outcome) in zip(todo, _map(_unpack_job, [bytes(r) for r in todo], workers)):
+        report[outcome] += 1
+        if unpacked is not None:
+            report['bytes_in'] += len(r)
+            _changed(r, unpacked)
+            report['bytes_out'] += len(r)
+
+    return report
+
+
+def verify_resources(resources, workers=None):
+    """Check that every compressed resource unpacks and packs back to the
+    same bytes, without changing anything. Returns a list of (resource,
+    outcome) pairs, where the outcome is 'good', 'sloppy' (only the slop
+    value differs), 'wrong mode', 'other', 'other format' or 'failed'.
+    """
+
+    todo = [r for r in resources if r.startswith(b'\xA8\x9Fer')]
+    return list(zip(todo, _map(_verify_job, [bytes(r) for r in todo], workers)))
@@ -0,0 +1,164 @@
+# Copyright (c) 2018-2020 Elliot Nunn
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+"""
+The BinHex 4.0 codecs that binascii dropped in Python 3.11, with the
+same behaviour: b2a_hqx and a2b_hqx for the 6-bit hqx alphabet, and
+rlecode_hqx and rledecode_hqx for the 0x90 run-length scheme.
+
+The hqx alphabet is base64 with different characters, so the 6-bit
+codecs are binascii's base64 with a bytes.translate on either side.
+The RLE codecs find runs with a regular expression (or NumPy, for large
+inputs when it is installed), so Python code only runs once per run, not
+once per byte.
+"""
+
+
+import binascii
+import re
+
+from .optional import numpy as _numpy
+
+
+HQX = b'!"#$%&\'()*+,-012345689@ABCDEFGHIJKLMNPQRSTUVXYZ[`abcdefhijklmpqr'
+BASE64 = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+
+_TO_HQX = bytes.maketrans(BASE64, HQX)
+_FROM_HQX = bytearray(b'!' * 256) # '!' is not base64, so it marks any other character
+for _c, _b in zip(HQX, BASE64): _FROM_HQX[_c] = _b
+_FROM_HQX = bytes(_FROM_HQX)
+
+_COLON = re.compile(b':')
+
+RUNCHAR = 0x90
+
+# Inputs at least this long are searched for runs with NumPy (if available)
+RLE_NUMPY_BYTES = 0x10000
+
+_RUN = re.compile(rb'([^\x90])\1{3,254}', re.DOTALL) # 4 to 255 of a byte other than RUNCHAR
+_CODE = re.compile(rb'\x90(.)?', re.DOTALL) # RUNCHAR and a count (0 for RUNCHAR itself)
+
+
+def b2a_hqx(data):
+    """Encode binary data as hqx characters (without line breaks or colons)."""
+    return binascii.b2a_base64(data, newline=False).rstrip(b'=').translate(_TO_HQX)
+
+
+def a2b_hqx(data):
+    """Decode hqx characters, skipping line breaks and stopping at a colon.
+
+    Returns (data, done), where done is 1 if the colon was reached.
+    Raises binascii.Incomplete if the characters do not end on a byte
+    boundary before the colon, and binascii.Error on other characters.
+    """
+
+    # Only copy up to the colon, and translate and drop line breaks in one pass
+    colon = _COLON.search(data)
+    done = colon is not None
+    with memoryview(data) as view:
+        data = bytes(view[:colon.start()] if done else view).translate(_FROM_HQX, b'\r\n')
+
+    if b'!' in data:
+        raise binascii.Error('Illegal char')
+
+    leftover = len(data) % 4
+    if leftover and not done:
+        raise binascii.Incomplete('String has incomplete number of bytes')
+    if leftover == 1: # 6 bits, not a whole byte
+        data = data[:-1]
+    elif leftover:
+        data += b'=' * (4 - leftover)
+
+    return binascii.a2b_base64(data), int(done)
+
+
+def _run(m):
+    run = m.group(0)
+    return run[:1] + bytes([RUNCHAR, len(run)])
+
+
+def _rlecode_numpy(np, data):
+    # Find where each run of equal bytes starts, then only loop over the long ones
+    a = np.frombuffer(data, np.uint8)
+    starts = np.flatnonzero(np.concatenate(([True], a[1:] != a[:-1])))
+    lengths = np.diff(np.append(starts, len(a)))
+    long = (lengths >= 4) & (a[starts] != RUNCHAR)
+
+    out = []
+    pos = 0
+    for start, length in zip(starts[long].tolist(), lengths[long].tolist()):
+        out.append(data[pos:start].replace(b'\x90', b'\x90\x00'))
+        pos = start + length
+        byte = data[start:start+1]
+        while length >= 4:
+            count = min(length, 255)
+            out.append(byte + bytes([RUNCHAR, count]))
+            length -= count
+        out.append(byte * length)
+    out.append(data[pos:].replace(b'\x90', b'\x90\x00'))
+    return b''.join(out)
+
+
+def rlecode_hqx(data):
+    """Compress runs of 4 to 255 bytes as (byte, RUNCHAR, count), and
+    escape RUNCHAR itself as (RUNCHAR, 0)."""
+
+    data = bytes(data)
+    np = len(data) >= RLE_NUMPY_BYTES and _numpy()
+    if np:
+        return _rlecode_numpy(np, data)
+    return b'\x90\x00'.join(_RUN.sub(_run, part) for part in data.split(b'\x90'))
+
+
+def rledecode_hqx(data):
+    """Expand what rlecode_hqx made.
+
+    Raises binascii.Incomplete if the data ends in the middle of a code,
+    and binascii.Error if it starts with a repeat code.
+    """
+
+    data = bytes(data)
+    if data[:1] == b'\x90' and data[1:2] not in (b'', b'\x00'):
+        raise binascii.Error('Orphaned RLE code at start')
+
+    # A repeat code repeats the last byte written, which is the byte before it,
+    # unless that byte was itself the end of a code
+    last_end = -1
+    last_byte = b''
+
+    def expand(m):
+        nonlocal last_end, last_byte
+        count = m.group(1)
+        if count is None:
+            raise binascii.Incomplete('')
+
+        start = m.start()
+        if count == b'\x00':
+            expanded = last_byte = b'\x90'
+        else:
+            if start != last_end:
+                last_byte = data[start-1:start]
+            expanded = last_byte * (count[0] - 1)
+        last_end = m.end()
+        return expanded
+
+    return _CODE.sub(expand, data)
@@ -28,7 +28,8 @@
 '''
 
 import struct
-from math import ceil, log2
+
+from . import stats
 
 
 LIT_MAX_LEN = 63 # maximal length of the literal block
@@ -84,201 +85,197 @@ litHuffTab = {
     0b11111 : (5, 32)
 }
 
-# TODO: can that be done more quickly?
-next_pow2 = lambda x: 1 if x < 2 else int(ceil(log2(x)))
-
 
-class BitStreamReader():
-    ''' Convenient methods for bitwise access to the input data.
+def make_lookup(tab, minlen, maxlen):
+    ''' Expand a Huffman table into a list indexed by the next maxlen bits
+        of the bitstream. Each entry is (code length, num_of_val_bits,
+        offset), or None for an invalid code, and codes are matched
+        shortest first.
     '''
-    def __init__(self, input, size, pos):
-        self.inBuf  = input
-        self.inSize = size
-        self.inPos  = pos
-        self.bPool  = 0
-        self.bitsInPool = 0
-
-    def showbits(self, nb):
-        ''' Return nb bits from the bitstream without advancing the bit position
-        '''
-        while nb > self.bitsInPool:
-            self.bPool = (self.bPool << 8) | self.inBuf[self.inPos]
-            self.inPos += 1
-            self.bitsInPool += 8
-
-        return (self.bPool >> (self.bitsInPool - nb)) & (0xFFFFFFFF >> (32 - nb))
-
-    def flushbits(self, nb):
-        ''' Advance bit position by nb
-        '''
-        if nb <= self.bitsInPool:
-            self.bitsInPool -= nb
-        else:
-            self.bitsInPool = 0
-
-    def getbits(self, nb):
-        ''' Same as showbits with advancing the bit position
-        '''
-        res = self.showbits(nb)
-        self.flushbits(nb)
-        return res
-
-    def decodehuff(self, tab, minlen, maxlen):
-        ''' Decode Huffman code from bitstream
-        '''
+    lookup = []
+    for bits in range(1 << maxlen):
+        entry = None
         for w in range(minlen, maxlen+1):
-            cw = self.showbits(w)
+            cw = bits >> (maxlen - w)
             if cw in tab:
                 val = tab[cw]
-                if isinstance(val, tuple): # compact format used?
-                    self.flushbits(w) # flush prefix bits
-                    nbits, start = val
-                    val = self.getbits(nbits) + start
-                    return val
-                self.flushbits(w)
-                return val
-
-        raise ValueError('Error decoding Huffman length')
-
-
-def DecodeDistance(bs, mag):
-    ''' Decode backward distance for reference copying. Because this values
-        can be large, the magnitude derived from the output position will be
-        used to switch between variable-length codes.
-        Large values will be further divided into sub-ranges; for each sub-range,
-        an additional bit indicating used/skipped sub-range, will be coded.
-
-        Below an example of decoding the bit string 10.0000111 and magnitude of 675:
-            1 -> skip sub-range 1...32
-            0 -> use sub-range 33...161
-                 getbits(7) -> 7 + 33 = 40
+                if isinstance(val, tuple): # compact format
+                    entry = (w,) + val
+                else:
+                    entry = (w, 0, val)
+                break
+        lookup.append(entry)
+    return lookup
+
+LEN_BITS = 11
+LIT_BITS = 7
+lenLookup = make_lookup(lenHuffTab, 2, LEN_BITS)
+litLookup = make_lookup(litHuffTab, 1, LIT_BITS)
+
+
+def next_pow2(x):
+    ''' Number of bits for a value below x (at least 1)
     '''
-    if mag <= 10:
-        raise ValueError('Anon9 unimplemented')
-
-    elif mag <= 20:
-        raise ValueError('Anon10 unimplemented')
-
-    elif mag <= 40:
-        if bs.getbits(1):
-            if bs.getbits(1) == 0:
-                return bs.getbits(4) + 5
-        raise ValueError('Unimplemented Anon11 distance encoding')
-
-    elif mag <= 80:
-        if bs.getbits(1):
-            if bs.getbits(1) == 0:
-                return bs.getbits(5) + 9
-        raise ValueError('Unimplemented Anon12 distance encoding')
-
-    elif mag <= 160:
-        if bs.getbits(1):
-            if bs.getbits(1) == 0:
-                return bs.getbits(6) + 17
-        raise ValueError('Unimplemented Anon13 distance encoding')
-
-    elif mag <= 672: # 161...672
-        if bs.getbits(1):
-            if bs.getbits(1) == 0: # 33...160
-                return bs.getbits(7) + 33
-            else:
-                return bs.getbits(next_pow2(mag - 160)) + 161
-        else: # 1...32
-            return bs.getbits(5) + 1
-
-    elif mag <= 1000:
-        if bs.getbits(1):
-            if bs.getbits(1) == 0:
-                return bs.getbits(8) + 65
-            else:
-                return bs.getbits(next_pow2(mag - 320)) + 321
-        else:
-            return bs.getbits(6) + 1
+    return max(1, (x - 1).bit_length())
 
-    elif mag <= 2688:
-        if bs.getbits(1):
-            if bs.getbits(1) == 0:
-                return bs.getbits(9) + 129
-            else:
-                return bs.getbits(next_pow2(mag - 640)) + 641
-        else:
-            return bs.getbits(7) + 1
 
-    elif mag <= 5376:
-        if bs.getbits(1):
-            if bs.getbits(1) == 0:
-                return bs.getbits(10) + 257
-            else:
-                return bs.getbits(next_pow2(mag - 1280)) + 1281
-        else:
-            return bs.getbits(8) + 1
+''' Backward distance codes. Because distances can be large, the magnitude
+    (the output position) selects a variable-length code. Large values are
+    further divided into sub-ranges, selected by a prefix: 0 for the short
+    range, 10 for the middle range and 11 for the long range, whose width
+    grows with the magnitude.
 
-    elif mag <= 10752:
-        if bs.getbits(1):
-            if bs.getbits(1):
-                return bs.getbits(next_pow2(mag - 2560)) + 2561
-            else:
-                return bs.getbits(11) + 513
-        else:
-            return bs.getbits(9) + 1
+    Below an example of decoding the bit string 10.0000111 and magnitude of 675:
+        1 -> skip sub-range 1...32
+        0 -> use sub-range 33...161
+             getbits(7) -> 7 + 33 = 40
+
+    One bracket per row, in order of magnitude:
+    (largest magnitude, short bits, middle bits, middle offset, long offset, name)
+    Brackets with a name have only the middle range implemented.
+'''
+DISTANCE_BRACKETS = (
+    (10,    None, None, None, None, 'Anon9'),
+    (20,    None, None, None, None, 'Anon10'),
+    (40,    None, 4,    5,    None, 'Anon11'),
+    (80,    None, 5,    9,    None, 'Anon12'),
+    (160,   None, 6,    17,   None, 'Anon13'),
+    (672,   5,    7,    33,   160,  None),
+    (1000,  6,    8,    65,   320,  None),
+    (2688,  7,    9,    129,  640,  None),
+    (5376,  8,    10,   257,  1280, None),
+    (10752, 9,    11,   513,  2560, None),
+)
 
-    raise ValueError('Unimplemented distance encoding, current dst mag: %d' % mag)
+
+def _bad_code():
+    raise ValueError('Error decoding Huffman length')
 
 
 def InstaCompDecompress(src, dst, unpackSize, pos=0):
+    ''' Decompress src[pos:] into the bytearray dst, replacing its contents.
+
+        The bit reader keeps up to 64 bits in an int, refilled 32 bits at
+        a time, with zeros past the end of the input. Reading past the end
+        is only an error if those bits are actually used.
+    '''
     # skip unused algo specific fields
     word, word2 = struct.unpack_from(">HH", src, pos)
     pos += 4
 
-    bs = BitStreamReader(src, len(src), pos)
+    inBuf = bytes(src[pos:]) + bytes(72) # room for a refill or a whole literal block past the end
+    inBits = 8 * (len(src) - pos)
+    inPos = 0
+    bPool = 0
+    bitsInPool = 0
 
+    dst[:] = bytes(unpackSize) # the last copy can run past unpackSize, making it longer
     dstPos = 0
     mode = 1 # 1 - literal decoding, 0 - reference copying
 
-    while dstPos < unpackSize:
-        copyCount = bs.decodehuff(lenHuffTab, 2, 11)
-        if copyCount > 0 or mode == 0:
-            copyCount += 2
-            if mode == 0:
-                copyCount += 1
-
-            distance = DecodeDistance(bs, dstPos)
-            refPos = dstPos - distance
-            #print("Distance: %d, ref pos: %d" % (distance, refPos))
+    brackets = iter(DISTANCE_BRACKETS)
+    bracket = next(brackets)
 
-            for i in range(copyCount):
-                dst.append(dst[refPos+i])
-
-            dstPos += copyCount
-            mode = 1
+    try:
+        while dstPos < unpackSize:
+            # Enough bits for a length code and its value
+            if bitsInPool < 32:
+                if inPos * 8 - bitsInPool > inBits: break # overran the input
+                bPool = ((bPool & ((1 << bitsInPool) - 1)) << 32) | int.from_bytes(inBuf[inPos:inPos+4], 'big')
+                inPos += 4
+                bitsInPool += 32
+
+            w, nbits, copyCount = lenLookup[(bPool >> (bitsInPool - LEN_BITS)) & 0x7FF] or _bad_code()
+            bitsInPool -= w + nbits
+            if nbits:
+                copyCount += (bPool >> bitsInPool) & ((1 << nbits) - 1)
+
+            if copyCount > 0 or mode == 0:
+                copyCount += 2
+                if mode == 0:
+                    copyCount += 1
+
+                # Enough bits for a distance code
+                if bitsInPool < 32:
+                    if inPos * 8 - bitsInPool > inBits: break
+                    bPool = ((bPool & ((1 << bitsInPool) - 1)) << 32) | int.from_bytes(inBuf[inPos:inPos+4], 'big')
+                    inPos += 4
+                    bitsInPool += 32
+
+                while dstPos > bracket[0]:
+                    bracket = next(brackets, None)
+                    if bracket is None:
+                        raise ValueError('Unimplemented distance encoding, current dst mag: %d' % dstPos)
+                top, shortBits, midBits, midStart, longStart, name = bracket
+
+                if midBits is None:
+                    raise ValueError('%s unimplemented' % name)
+
+                bitsInPool -= 1
+                if (bPool >> bitsInPool) & 1:
+                    bitsInPool -= 1
+                    if (bPool >> bitsInPool) & 1:
+                        if longStart is None:
+                            raise ValueError('Unimplemented %s distance encoding' % name)
+                        nb = next_pow2(dstPos - longStart)
+                        start = longStart + 1
+                    else:
+                        nb = midBits
+                        start = midStart
+                else:
+                    if shortBits is None:
+                        raise ValueError('Unimplemented %s distance encoding' % name)
+                    nb = shortBits
+                    start = 1
+                bitsInPool -= nb
+                distance = ((bPool >> bitsInPool) & ((1 << nb) - 1)) + start
+
+                refPos = dstPos - distance
+                if refPos < 0:
+                    raise IndexError('Distance %d is before the start of the data' % distance)
+
+                if distance >= copyCount:
+                    dst[dstPos:dstPos+copyCount] = dst[refPos:refPos+copyCount]
+                else: # overlapping, so the last distance bytes repeat
+                    dst[dstPos:dstPos+copyCount] = (dst[refPos:dstPos] * (copyCount // distance + 1))[:copyCount]
+
+                dstPos += copyCount
+                mode = 1
 
-        else:
-            litLen = bs.decodehuff(litHuffTab, 1, 7)
+            else:
+                w, nbits, litLen = litLookup[(bPool >> (bitsInPool - LIT_BITS)) & 0x7F]
+                bitsInPool -= w + nbits
+                if nbits:
+                    litLen += (bPool >> bitsInPool) & ((1 << nbits) - 1)
 
-            for i in range(litLen):
-                dst.append(bs.getbits(8))
+                # The literals are whole bytes at any bit position, so take them straight from the input
+                bitPos = inPos * 8 - bitsInPool
+                first = bitPos >> 3
+                chunk = int.from_bytes(inBuf[first:first+litLen+1], 'big') >> (8 - (bitPos & 7))
+                dst[dstPos:dstPos+litLen] = (chunk & ((1 << (8 * litLen)) - 1)).to_bytes(litLen, 'big')
 
-            dstPos += litLen
-            mode = 0 if litLen < LIT_MAX_LEN else 1
+                bitPos += 8 * litLen
+                inPos = (bitPos >> 3) + 1
+                bPool = inBuf[inPos - 1]
+                bitsInPool = 8 - (bitPos & 7)
 
-    #print(hex(bs.getbits(3)))
-    #print(hex(bs.getbits(1)))
-    #print(hex(bs.getbits(7)))
-    #print(hex(bs.getbits(3)))
+                dstPos += litLen
+                mode = 0 if litLen < LIT_MAX_LEN else 1
 
-    #print(hex(bs.getbits(1)))
-    #print(hex(bs.getbits(2)))
-    #print(hex(bs.getbits(4)))
-    #print(hex(bs.getbits(2)))
+    except ValueError:
+        if inPos * 8 - bitsInPool <= inBits: raise
+        # Otherwise the bad code came from past the end
 
-    print("current src pos: %d, current dst pos: %d" % (bs.inPos, dstPos))
+    if inPos * 8 - bitsInPool > inBits:
+        raise IndexError('InstaComp data is truncated')
 
 
-# End of Max's unchanged code. Here is a simple wrapper...
+# Here is a simple wrapper...
 class WrongFormatError(ValueError):
     pass
 
 
+@stats.instrument('instacomp.unpack', data=0)
 def unpack(src):
     try:
         magic, hdrLen, vers, iscmp, unpackSize, dcmp = struct.unpack_from(">LHBBLH", src)
@@ -291,3 +288,175 @@ def unpack(src):
     dst = bytearray()
     InstaCompDecompress(src, dst, unpackSize, 14)
     return dst
+
+
+# Compression: LZ77 with a hash chain, emitting only what InstaCompDecompress can decode
+
+def _make_codes(lookup, maxlen):
+    # Invert a lookup table into {value: (bits, number of bits)}
+    codes = {}
+    for bits, entry in enumerate(lookup):
+        if entry is None: continue
+        w, nbits, start = entry
+        cw = bits >> (maxlen - w)
+        for extra in range(1 << nbits):
+            codes.setdefault(start + extra, ((cw << nbits) | extra, w + nbits))
+    return codes
+
+lenCodes = _make_codes(lenLookup, LEN_BITS)
+litCodes = _make_codes(litLookup, LIT_BITS)
+
+MIN_MATCH = 3
+MAX_MATCH = max(lenCodes) + 2 # in the mode that adds 2
+
+# Copies are only possible where DISTANCE_BRACKETS has codes: not too early and not too late
+FIRST_COPY = DISTANCE_BRACKETS[1][0] + 1
+LAST_COPY = DISTANCE_BRACKETS[-1][0]
+
+''' Effort levels: (hash chain positions to try, lazy matching, good enough match length)
+'''
+LEVELS = {
+    1: (4, False, 32),
+    2: (32, True, 64),
+    3: (512, True, MAX_MATCH),
+}
+
+
+def _distance_range(mag):
+    # Smallest and largest distance that can be coded at this output position
+    for top, shortBits, midBits, midStart, longStart, name in DISTANCE_BRACKETS:
+        if mag <= top:
+            if midBits is None: return None
+            if shortBits is None: return midStart, min(mag, midStart + (1 << midBits) - 1)
+            return 1, mag
+    return None
+
+
+def _distance_code(mag, distance):
+    # (bits, number of bits) for a distance that _distance_range allows
+    for top, shortBits, midBits, midStart, longStart, name in DISTANCE_BRACKETS:
+        if mag <= top: break
+
+    if shortBits is not None and distance <= 1 << shortBits:
+        return distance - 1, 1 + shortBits
+    elif longStart is None or distance <= longStart:
+        return (0b10 << midBits) | (distance - midStart), 2 + midBits
+    else:
+        nb = next_pow2(mag - longStart)
+        return (0b11 << nb) | (distance - longStart - 1), 2 + nb
+
+
+def _find_match(src, pos, head, chain, tries, limit):
+    # Longest match for src[pos:] allowed here, as (length, distance), nearest first among equals
+    if limit < MIN_MATCH or not FIRST_COPY <= pos <= LAST_COPY: return 0, 0
+
+    lo, hi = _distance_range(pos)
+    best = bestDist = 0
+    candidate = head.get(src[pos:pos+MIN_MATCH], -1)
+    while candidate >= 0 and tries:
+        distance = pos - candidate
+        if distance > hi: break
+        if distance >= lo and src[candidate+best] == src[pos+best]:
+            # Compare 8 bytes at a time, then single bytes
+            n = 0
+            while n + 8 <= limit and src[candidate+n:candidate+n+8] == src[pos+n:pos+n+8]:
+                n += 8
+            while n < limit and src[candidate+n] == src[pos+n]:
+                n += 1
+            if n > best:
+                best, bestDist = n, distance
+                if n >= limit: break
+        candidate = chain[candidate]
+        tries -= 1
+
+    if best < MIN_MATCH: return 0, 0
+    return best, bestDist
+
+
+@stats.instrument('instacomp.pack', data=0)
+def pack(src, level=2):
+    ''' Compress data with InstaComp (dcmp 3). The `level` of effort is
+        1, 2 or 3 (see LEVELS). If the result would not be smaller, the
+        data is returned unchanged, as greggybits.pack does.
+    '''
+    data = bytes(src)
+    tries, lazy, goodEnough = LEVELS[level]
+    end = len(data)
+
+    out = bytearray(struct.pack(">LHBBLHHH", 0xA89F6572, 18, 9, 1, end, 3, 0, 0))
+    acc = 0 # bits not yet in out
+    accBits = 0
+
+    def put(value, nbits):
+        nonlocal acc, accBits
+        acc = (acc << nbits) | value
+        accBits += nbits
+        if accBits >= 64:
+            keep = accBits & 7
+            out.extend((acc >> keep).to_bytes(accBits >> 3, 'big'))
+            acc &= (1 << keep) - 1
+            accBits = keep
+
+    head = {} # 3 bytes: most recent position
+    chain = [-1] * end # position: previous position with the same 3 bytes
+    inserted = 0 # positions below this are in the hash chain
+
+    def insert(upto):
+        nonlocal inserted
+        while inserted < upto and inserted + MIN_MATCH <= end:
+            key = data[inserted:inserted+MIN_MATCH]
+            chain[inserted] = head.get(key, -1)
+            head[key] = inserted
+            inserted += 1
+
+    def emit_literals(start, stop):
+        # In blocks of at most LIT_MAX_LEN, returning the mode that follows
+        mode = 1
+        while start < stop:
+            n = min(stop - start, LIT_MAX_LEN)
+            put(*lenCodes[0])
+            put(*litCodes[n])
+            put(int.from_bytes(data[start:start+n], 'big'), 8 * n)
+            start += n
+            mode = 0 if n < LIT_MAX_LEN else 1
+        return mode
+
+    litStart = pos = 0
+    pending = None
+    while pos < end:
+        if pending is None:
+            insert(pos)
+            length, distance = _find_match(data, pos, head, chain, tries, min(MAX_MATCH, end - pos))
+        else:
+            length, distance = pending
+            pending = None
+
+        # Lazy matching: maybe a literal then a longer copy is better
+        if length and lazy and length < goodEnough and pos + 1 < end:
+            insert(pos + 1)
+            pending = _find_match(data, pos + 1, head, chain, tries, min(MAX_MATCH, end - pos - 1))
+            if pending[0] > length:
+                pos += 1
+                continue
+            pending = None
+
+        if not length:
+            pos += 1
+            continue
+
+        # After a short literal block the decoder expects a copy, and adds 3 to its length code (not 2)
+        mode = emit_literals(litStart, pos)
+        put(*lenCodes[length - 3 if mode == 0 else length - 2])
+        put(*_distance_code(pos, distance))
+
+        pos += length
+        litStart = pos
+
+    emit_literals(litStart, end)
+    if accBits:
+        put(0, -accBits % 8)
+        out.extend(acc.to_bytes(accBits >> 3, 'big'))
+
+    if len(out) >= len(data):
+        return src
+    return out
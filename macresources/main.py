@@ -19,11 +19,18 @@
 # SOFTWARE.
 
 
+import abc
+import binascii
 import collections
+import hashlib
+import io
 import struct
 import enum
+import functools
 import re
 
+from . import optional, stats
+
 
 # The allowed token sequence when parsing Rez code (quite restrictive)
 rez_tokens = [
@@ -52,8 +59,18 @@ rez_tokenizer = re.compile(rez_tokenizer)
 
 
 class RezSyntaxError(Exception):
-    def __init__(self, msg):
+    """A problem with Rez code, at a byte offset and a 1-based line and column.
+
+    Offsets count from the start of the code after CR and CRLF line endings
+    have been converted to LF.
+    """
+
+    def __init__(self, msg, filename=None, offset=None, line=None, column=None):
         self.msg = msg
+        self.filename = filename
+        self.offset = offset
+        self.line = line
+        self.column = column
 
     def __str__(self):
        return self.msg
@@ -110,13 +127,22 @@ def attribs_for_derez(attribs):
         if attribs & 0x04: yield 'preload'
 
 
-class Resource(bytearray):
+# Every Resource with the same type code shares one bytes object
+_type_codes = {}
+
+
+class Resource(bytearray, metaclass=abc.ABCMeta):
     """
     A single Mac resource. A four-byte type, a numeric id and some
     binary data are essential. Extra attributes and a name string are
     optional.
     """
 
+    # Slots keep small resources small. There is still a __dict__ for
+    # callers that hang their own attributes on a Resource, but it is
+    # only created when first used.
+    __slots__ = ('_type', 'id', '_name', 'attribs', '_packed_digest', '__dict__', '__weakref__')
+
     def __init__(self, type, id, name=None, attribs=0, data=b''):
         self.type = type
         self.id = id
@@ -124,11 +150,54 @@ class Resource(bytearray):
         self.name = name
         self.attribs = attribs
 
+    # Modifying the data forgets the digest that DecompressCache.key remembered
+    def _forgets_digest(method):
+        @functools.wraps(method)
+        def mutator(self, *args):
+            self._packed_digest = None
+            return method(self, *args)
+        return mutator
+
+    __setitem__ = _forgets_digest(bytearray.__setitem__)
+    __delitem__ = _forgets_digest(bytearray.__delitem__)
+    __iadd__ = _forgets_digest(bytearray.__iadd__)
+    __imul__ = _forgets_digest(bytearray.__imul__)
+    append = _forgets_digest(bytearray.append)
+    extend = _forgets_digest(bytearray.extend)
+    insert = _forgets_digest(bytearray.insert)
+    pop = _forgets_digest(bytearray.pop)
+    remove = _forgets_digest(bytearray.remove)
+    reverse = _forgets_digest(bytearray.reverse)
+    clear = _forgets_digest(bytearray.clear)
+    del _forgets_digest
+
     def __repr__(self):
         datarep = repr(bytes(self.data[:4]))
         if len(self.data) > len(datarep): datarep += '...%sb' % len(self.data)
         return '%s(type=%r, id=%r, name=%r, attribs=%r, data=%s)' % (self.__class__.__name__, self.type, self.id, self.name, self.attribs, datarep)
 
+    @property
+    def type(self):
+        return self._type
+
+    @type.setter
+    def type(self, set_to):
+        if isinstance(set_to, bytes):
+            set_to = _type_codes.setdefault(set_to, set_to)
+        self._type = set_to
+
+    @property
+    def name(self):
+        # Names from a resource file are kept as raw Mac Roman until needed
+        name = self._name
+        if isinstance(name, bytes):
+            name = self._name = name.decode('mac_roman')
+        return name
+
+    @name.setter
+    def name(self, set_to):
+        self._name = set_to
+
     @property
     def data(self):
         return self
@@ -137,13 +206,188 @@ class Resource(bytearray):
     def data(self, set_to):
         self[:] = set_to
 
+    def unpacked(self, cache=None):
+        """Get the data, decompressed if the resource is compressed (see
+        macresources.dcmp). Decompressed data is read-only and is cached."""
+        from . import dcmp
+        return dcmp.unpack_resource(self, cache)
+
+
+class ResourceView:
+    """
+    A Mac resource whose data is a read-only view into a larger buffer,
+    such as an mmap of a whole resource fork. Behaves like a Resource,
+    and isinstance() says it is one, but the data is only copied into a
+    private bytearray when the resource is first modified.
+
+    The bytearray methods that only read (find, decode, split...) work
+    on a copy of an unmodified view. On Python 3.12 and later the view
+    also exports the buffer protocol, so f.write, struct and re take it
+    directly; older Pythons cannot do that for a pure Python class, and
+    raise TypeError, so use the `data` attribute there.
+    """
+
+    __slots__ = ('_type', 'id', '_name', 'attribs', '_data', '_packed_digest', '__dict__', '__weakref__')
+
+    type = Resource.type
+    name = Resource.name
+    unpacked = Resource.unpacked
+
+    def __init__(self, type, id, name=None, attribs=0, data=b''):
+        self.type = type
+        self.id = id
+        self._data = memoryview(data).toreadonly()
+        self._packed_digest = None
+        self.name = name
+        self.attribs = attribs
+
+    def __repr__(self):
+        datarep = repr(bytes(self._data[:4]))
+        if len(self._data) > len(datarep): datarep += '...%sb' % len(self._data)
+        return '%s(type=%r, id=%r, name=%r, attribs=%r, data=%s)' % (self.__class__.__name__, self.type, self.id, self.name, self.attribs, datarep)
+
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, set_to):
+        self._data = bytearray(set_to)
+        self._packed_digest = None
+
+    def _writable(self):
+        # Copy-on-write, and every change comes through here
+        self._packed_digest = None
+        if isinstance(self._data, memoryview):
+            self._data = bytearray(self._data)
+        return self._data
+
+    def _readable(self):
+        # What the bytearray methods are run on
+        if isinstance(self._data, memoryview):
+            return bytearray(self._data)
+        return self._data
+
+    def __buffer__(self, flags):
+        if flags & 1: # PyBUF_WRITABLE
+            return memoryview(self._writable())
+        return memoryview(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return bytearray(self._data[key])
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        self._writable()[key] = value
+
+    def __delitem__(self, key):
+        del self._writable()[key]
+
+    def __iadd__(self, other):
+        self._writable().extend(other)
+        return self
+
+    def __imul__(self, count):
+        data = self._writable()
+        data *= count
+        return self
+
+    def __add__(self, other):
+        if isinstance(other, ResourceView): other = other._data
+        return bytearray(self._data) + other
+
+    def __radd__(self, other):
+        return other + bytes(self._data)
+
+    def __mul__(self, count):
+        return bytearray(self._data) * count
+
+    __rmul__ = __mul__
+
+    def append(self, item):
+        self._writable().append(item)
+
+    def extend(self, iterable):
+        self._writable().extend(iterable)
+
+    def insert(self, index, item):
+        self._writable().insert(index, item)
+
+    def pop(self, index=-1):
+        return self._writable().pop(index)
+
+    def remove(self, value):
+        self._writable().remove(value)
+
+    def reverse(self):
+        self._writable().reverse()
+
+    def clear(self):
+        self._writable().clear()
+
+    def __bytes__(self):
+        return bytes(self._data)
+
+    def __eq__(self, other):
+        if isinstance(other, ResourceView): other = other._data
+        return self._data == other
+
+    __hash__ = None
+
+    def hex(self, *args):
+        return self._data.hex(*args)
+
+    def startswith(self, prefix, *args):
+        if args or isinstance(prefix, tuple):
+            return self._readable().startswith(prefix, *args)
+        return bytes(self._data[:len(prefix)]) == prefix # often a header check, so copy only that much
+
+
+
+def _reads_a_copy(method):
+    @functools.wraps(method)
+    def reader(self, *args, **kwargs):
+        args = [a._data if isinstance(a, ResourceView) else a for a in args]
+        return method(self._readable(), *args, **kwargs)
+    return reader
+
+for _name in ('__contains__', '__lt__', '__le__', '__gt__', '__ge__', '__mod__',
+        'capitalize', 'center', 'copy', 'count', 'decode', 'endswith', 'expandtabs', 'find',
+        'index', 'isalnum', 'isalpha', 'isascii', 'isdigit', 'islower', 'isspace', 'istitle',
+        'isupper', 'join', 'ljust', 'lower', 'lstrip', 'partition', 'removeprefix', 'removesuffix',
+        'replace', 'rfind', 'rindex', 'rjust', 'rpartition', 'rsplit', 'rstrip', 'split',
+        'splitlines', 'strip', 'swapcase', 'title', 'translate', 'upper', 'zfill'):
+    setattr(ResourceView, _name, _reads_a_copy(getattr(bytearray, _name)))
+del _name
+
+Resource.register(ResourceView) # so isinstance(view, Resource) holds
 
-def parse_file(from_resfile):
-    """Get an iterator of Resource objects from a binary resource file."""
+
+@stats.instrument('parse_file', data=0)
+def parse_file(from_resfile, lazy=False):
+    """Get an iterator of Resource objects from a binary resource file.
+
+    Anything supporting the buffer protocol is accepted (bytes,
+    memoryview, mmap). With `lazy`, ResourceView objects are returned,
+    sharing memory with `from_resfile` until they are modified.
+    """
 
     if not from_resfile: # empty resource forks are fine
         return
 
+    view = memoryview(from_resfile).toreadonly()
+    if lazy:
+        cls = ResourceView
+    else:
+        cls = Resource
+
     data_offset, map_offset, data_len, map_len = struct.unpack_from('>4L', from_resfile)
 
     typelist_offset, namelist_offset, numtypes = struct.unpack_from('>24xHHH', from_resfile, map_offset)
@@ -169,16 +413,16 @@ def parse_file(from_resfile):
             rdata_offset += data_offset
 
             rdata_len, = struct.unpack_from('>L', from_resfile, rdata_offset)
-            rdata = from_resfile[rdata_offset+4:rdata_offset+4+rdata_len]
+            rdata = view[rdata_offset+4:rdata_offset+4+rdata_len]
 
-            if name_offset == 0xFFFF:
-                name = None
-            else:
+            res = cls(type=rtype, id=rid, attribs=rattribs, data=rdata)
+
+            if name_offset != 0xFFFF:
                 name_offset += namelist_offset
-                name_len = from_resfile[name_offset]
-                name = from_resfile[name_offset+1:name_offset+1+name_len].decode('mac_roman')
+                name_len = view[name_offset]
+                res._name = bytes(view[name_offset+1:name_offset+1+name_len]) # decoded on demand
 
-            yield Resource(type=rtype, id=rid, name=name, attribs=rattribs, data=bytearray(rdata))
+            yield res
 
 
 def string_surrogate(m):
@@ -210,59 +454,234 @@ def string_literal(string):
     return re.sub(rb'(\\0x..|\\.)', string_surrogate, string[1:-1])
 
 
-def parse_rez_code(from_rezcode, original_file='<string>'):
-    """Get an iterator of Resource objects from code in a subset of the Rez language (bytes or str)."""
+# The layout of each line of hex data that make_rez_code emits, counted
+# from the $ (the tab at offset 77 introduces the next line)
+HEXLINE_LEN = 78
+HEXLINE_FIXED = [(0, b'$'), (1, b'"'), (41, b'"'), (54, b'/'), (55, b'*'), (56, b' '), (73, b' '), (74, b'*'), (75, b'/'), (76, b'\n')]
+HEXLINE_FIXED += [(6 + 5*i, b' ') for i in range(7)] + [(i, b' ') for i in range(42, 54)]
+HEXLINE_DIGITS = [2 + 5*i + j for i in range(8) for j in range(4)]
+HEXLINE_COMMENT = range(57, 73)
 
+
+def _scan_hex_lines(buf, pos):
+    """Decode a run of canonical hex lines in bulk, starting at the $ of the first.
+
+    Returns (data, new_pos), or None if there is no complete line to scan,
+    or False if the lines are not in the canonical layout (in which case the
+    regex tokenizer must be used instead). A line is only accepted if the
+    regex tokenizer would read it as one hex token plus one
+    whitespace/comment token.
+    """
+
+    end = buf.find(b'};', pos)
+    if end == -1: end = len(buf)
+    numlines = (end - pos + 1) // HEXLINE_LEN
+    if not numlines: return None
+    end = pos + numlines * HEXLINE_LEN - 1 # just past the last newline
+
+    for offset, ch in HEXLINE_FIXED:
+        if buf[pos+offset:end:HEXLINE_LEN] != ch * numlines:
+            return False
+    if buf[pos+77:end:HEXLINE_LEN] != b'\t' * (numlines - 1):
+        return False
+
+    # Newlines or premature star-slashes would break the comment token
+    # (the extra byte per line keeps lines apart)
+    comments = bytearray(17 * numlines)
+    for i, offset in enumerate(HEXLINE_COMMENT):
+        comments[i::17] = buf[pos+offset:end:HEXLINE_LEN]
+    if b'\n' in comments or b'*/' in comments:
+        return False
+
+    hex_column = bytearray(32 * numlines)
+    for i, offset in enumerate(HEXLINE_DIGITS):
+        hex_column[i::32] = buf[pos+offset:end:HEXLINE_LEN]
     try:
-        from_rezcode = from_rezcode.encode('mac_roman')
-    except AttributeError:
-        pass
+        data = bytes.fromhex(hex_column.decode('ascii'))
+    except ValueError: # including UnicodeDecodeError
+        return False
+    if len(data) != 16 * numlines: # whitespace where digits should be
+        return False
+
+    return data, end
+
+
+class _RezReader:
+    """Deliver Rez code from a file object or buffer in chunks, with CR and CRLF converted to LF."""
+
+    def __init__(self, source):
+        try:
+            self.view = memoryview(source).cast('B')
+        except TypeError:
+            self.view = None
+            self.file = source
+        self.source = source
+        self.viewpos = 0
+        self.pending_cr = False
+        self.eof = False
+
+    def read(self, n):
+        if self.eof: return b''
+
+        if self.view is None:
+            chunk = self.file.read(n)
+            if isinstance(chunk, str): # text-mode file
+                chunk = chunk.encode('mac_roman')
+        elif self.viewpos == 0 and n >= len(self.view) and type(self.source) is bytes:
+            chunk = self.source # no need to copy
+            self.viewpos = len(chunk)
+        else:
+            chunk = bytes(self.view[self.viewpos:self.viewpos+n])
+            self.viewpos += len(chunk)
+
+        if not chunk:
+            self.eof = True
+            return b'\n' if self.pending_cr else b''
+
+        # Hold back a CR that might be the first half of a CRLF
+        if self.pending_cr:
+            chunk = b'\r' + chunk
+        self.pending_cr = chunk.endswith(b'\r')
+        if self.pending_cr:
+            chunk = chunk[:-1]
+
+        return chunk.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+
+
+def _rez_fingerprint(resource):
+    return (resource.type, resource.id, resource.name, resource.attribs, len(resource),
+        hashlib.blake2b(resource.data, digest_size=16).digest())
+
 
-    from_rezcode = from_rezcode.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+def _parse_rez(reader, original_file, chunk_size, fast_hex=True, errors=None, keep_source=None):
+    """Run the Rez parser over code delivered by a _RezReader.
 
-    # Slightly faster than finditer
-    all_tokens = rez_tokenizer.findall(from_rezcode)
-    def line_no_for_error(token_idx):
-        # Redo all the lexing with finditer, which is slower but
-        # gives us Match objects with a byte offset
-        work_redoer = rez_tokenizer.finditer(from_rezcode)
-        match_obj = next(m for i, m in enumerate(work_redoer) if i == token_idx)
-        line_no = from_rezcode[:match_obj.start()].count(ord('\n')) + 1
+    Tokens are lexed one at a time. A token that reaches the end of the
+    buffer might continue in the next chunk, and an unexpected character
+    might be the start of a token that does, so in either case more code is
+    read and the token is lexed again.
+
+    Inside a data block, runs of lines in the layout that make_rez_code
+    emits are decoded in bulk by _scan_hex_lines. The regex tokenizer takes
+    over for the rest of the block as soon as a line does not fit.
+
+    Newlines are counted as each resource is finished (and before the
+    buffer is discarded), so a syntax error only needs to count back to the
+    start of its resource to find its line and column.
+
+    If `errors` is a list, syntax errors are appended to it instead of
+    raised, and the rest of the bad resource is skipped.
+
+    If `keep_source` is the whole code as bytes, each Resource gets a
+    _rez_source attribute recording its span of the code and a fingerprint
+    of its contents, so that an unchanged resource need not be rendered
+    again.
+    """
+
+    if keep_source is not None:
+        all_ascii = keep_source.isascii()
+
+    buf = b''
+    pos = 0
+    buf_offset = 0 # of buf[0] in the whole code
+    match = rez_tokenizer.match
+
+    # The position index: lines and line_start are correct up to counted_pos
+    counted_pos = 0
+    lines = 0
+    line_start = 0
+
+    def advance_index(to):
+        nonlocal counted_pos, lines, line_start
+        n = buf.count(b'\n', counted_pos, to)
+        if n:
+            lines += n
+            line_start = buf_offset + buf.rindex(b'\n', counted_pos, to) + 1
+        counted_pos = to
+
+    skipping = False
+    def fail(offset, why=None):
+        nonlocal skipping, allowed_token_kinds, in_hex_block
+        advance_index(offset)
+        offset += buf_offset
+        column = offset - line_start + 1
+        msg = 'File %r, line %r, column %r' % (original_file, lines + 1, column)
+        if why: msg += ', ' + why
+        err = RezSyntaxError(msg, original_file, offset, lines + 1, column)
+        if errors is None: raise err
+        errors.append(err)
+        skipping = True
+        allowed_token_kinds = (2,-1)
+        in_hex_block = False
 
     allowed_token_kinds = (2,-1)
-    for token_idx, token_captures in enumerate(all_tokens):
+    in_hex_block = False
+    while True:
+        if in_hex_block and fast_hex_this_block and buf.startswith(b'$"', pos):
+            scanned = _scan_hex_lines(buf, pos)
+            if scanned:
+                data, pos = scanned
+                res += data
+                continue
+            elif scanned is False:
+                fast_hex_this_block = False
+
+        m = match(buf, pos)
+
+        if not reader.eof and (m is None or m.end() == len(buf) or m.lastindex == 14):
+            # Read at least as much again as we have buffered, to avoid quadratic behaviour on huge tokens
+            more = reader.read(max(chunk_size, len(buf) - pos))
+            advance_index(pos)
+            buf_offset += pos
+            buf = buf[pos:] + more
+            pos = counted_pos = 0
+            continue
+
+        if m is None: break # end of file
+
         # Which single capture is non-empty?
-        for token_kind, payload in enumerate(token_captures):
-            if payload: break
+        token_kind = m.lastindex - 1
+        payload = m.group(m.lastindex)
+        if not payload: token_kind = 13 # e.g. $"", an empty hex literal, is an error
+        token_start = pos
+        pos = m.end()
 
         # Ignore whitespace
         if not token_kind: continue
 
+        # After an error, resume at the next resource
+        if skipping:
+            if token_kind != 2: continue
+            skipping = False
+
         # Unexpected token!
         if token_kind not in allowed_token_kinds:
-            raise RezSyntaxError('File %r, line %r' % (original_file, line_no_for_error(token_idx)))
+            fail(token_start)
+            if token_kind != 2: continue
+            skipping = False # a stray "data" starts the next resource
 
-        elif token_kind == 1:
-            hex_accum.append(payload)
+        if token_kind == 1:
+            res += bytes.fromhex(payload.decode('ascii'))
 
         elif token_kind == 2:
             res = Resource(b'', 0)
-            hex_accum = []
+            res_start = buf_offset + token_start
+            fast_hex_this_block = fast_hex
 
         elif token_kind == 3:
             res.type = string_literal(payload)
             if len(res.type) != 4:
-                raise RezSyntaxError('File %r, line %r, type not 4 chars' % (original_file, line_no_for_error(token_idx)))
+                fail(token_start, 'type not 4 chars')
 
         elif token_kind == 5:
             res.id = int(payload)
             if not (-65536 <= res.id < 65536):
-                raise RezSyntaxError('File %r, line %r, ID out of 16-bit range' % (original_file, line_no_for_error(token_idx)))
+                fail(token_start, 'ID out of 16-bit range')
 
         elif token_kind == 6:
             res.name = string_literal(payload).decode('mac_roman')
             if len(res.name) > 255:
-                raise RezSyntaxError('File %r, line %r, name > 255 chars' % (original_file, line_no_for_error(token_idx)))
+                fail(token_start, 'name > 255 chars')
 
         elif token_kind == 7:
             res.attribs = int(payload, 16)
@@ -280,43 +699,91 @@ def parse_rez_code(from_rezcode, original_file='<string>'):
                 res.attribs |= 0x04
 
         elif token_kind == 12:
-            res[:] = bytes.fromhex(b''.join(hex_accum).decode('ascii'))
+            advance_index(pos)
+            if keep_source is not None:
+                res_stop = buf_offset + pos
+                is_ascii = all_ascii or keep_source[res_start:res_stop].isascii()
+                res._rez_source = (keep_source, res_start, res_stop, is_ascii, _rez_fingerprint(res))
             yield res
 
-        allowed_token_kinds = allowed_to_follow_kind[token_kind]
+        if not skipping:
+            allowed_token_kinds = allowed_to_follow_kind[token_kind]
+            in_hex_block = token_kind in (1, 10)
 
     # Premature EOF
     if -1 not in allowed_token_kinds:
-        raise RezSyntaxError('File %r, unexpected end of file' % original_file)
+        fail(len(buf), 'unexpected end of file')
 
 
-def make_file(from_iter, align=1):
-    """Pack an iterator of Resource objects into a binary resource file."""
+@stats.instrument('parse_rez_code', data=0)
+def parse_rez_code(from_rezcode, original_file='<string>', keep_source=False):
+    """Get an iterator of Resource objects from code in a subset of the Rez language (bytes or str).
 
-    class wrap:
-        def __init__(self, from_obj):
-            self.obj = from_obj
+    With `keep_source`, each resource remembers its original code, and
+    make_rez_code and friends copy that code through verbatim for as long
+    as the resource is unchanged.
+    """
 
-    accum = bytearray(256) # defer header
+    try:
+        from_rezcode = from_rezcode.encode('mac_roman')
+    except AttributeError:
+        pass
+
+    # The whole code is handed to the parser as a single chunk
+    if b'\r' in from_rezcode:
+        from_rezcode = from_rezcode.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+    if keep_source:
+        keep_source = bytes(from_rezcode) # resources will share it
+    else:
+        keep_source = None
+    reader = _RezReader(from_rezcode)
+    return _parse_rez(reader, original_file, len(from_rezcode) + 1, keep_source=keep_source)
+
+
+@stats.instrument('parse_rez_stream')
+def parse_rez_stream(from_file, original_file=None, chunk_size=0x10000):
+    """Get an iterator of Resource objects from Rez code in a file object or buffer (e.g. an mmap).
+
+    The code is read and lexed in chunks, and each Resource is returned as
+    soon as its closing `};` is seen, so memory use is bounded by the size
+    of the largest resource rather than the whole file.
+    """
+
+    if original_file is None:
+        original_file = getattr(from_file, 'name', '<stream>')
+
+    return _parse_rez(_RezReader(from_file), original_file, chunk_size)
+
+
+def validate_rez_code(from_rezcode, original_file='<string>'):
+    """Check Rez code (bytes, str, buffer or file object) in one pass, returning a list of every RezSyntaxError.
+
+    Parsing resumes at the next resource after each error, so every bad
+    resource is reported.
+    """
+
+    try:
+        from_rezcode = from_rezcode.encode('mac_roman')
+    except AttributeError:
+        pass
+
+    errors = []
+    for res in _parse_rez(_RezReader(from_rezcode), original_file, 0x10000, errors=errors):
+        pass
+    return errors
 
-    data_offset = len(accum)
-    bigdict = collections.OrderedDict() # maintain order of types, but manually order IDs
-    for r in from_iter:
-        wrapped = wrap(r)
 
-        while len(accum) % align:
-            accum.extend(b'\x00')
+def _make_map(bigdict, data_len):
+    """Build the header and resource map for a file whose data is laid out already.
 
-        wrapped.data_offset = len(accum)
-        accum.extend(struct.pack('>L', len(r.data)))
-        accum.extend(r.data)
+    `bigdict` maps each type to a list of (id, name, attribs, offset)
+    tuples, where each offset is relative to the start of the data.
+    """
 
-        if r.type not in bigdict:
-            bigdict[r.type] = []
-        bigdict[r.type].append(wrapped)
+    data_offset = 256
+    map_offset = data_offset + data_len
 
-    map_offset = len(accum)
-    accum.extend(bytes(28))
+    accum = bytearray(28)
 
     typelist_offset = len(accum)
     accum.extend(bytes(2 + 8 * len(bigdict)))
@@ -325,129 +792,532 @@ def make_file(from_iter, align=1):
     resource_count = sum(len(idlist) for idlist in bigdict.values())
     accum.extend(bytes(12 * resource_count))
 
+    # all right, now populate the name list and the reference lists...
     namelist_offset = len(accum)
-    for rtype, idlist in bigdict.items():
-        for res in idlist:
-            if res.obj.name is not None:
-                res.name_offset = len(accum)
-                as_bytes = res.obj.name.encode('mac_roman')
-                accum.append(len(as_bytes))
-                accum.extend(as_bytes)
-
-    # all right, now populate the reference lists...
     counter = reflist_offset
     for rtype, idlist in bigdict.items():
-        for res in idlist:
-            res.ref_offset = counter
-            if res.obj.name is None:
+        for rid, name, attribs, this_data_offset in idlist:
+            if name is None:
                 this_name_offset = 0xFFFF
             else:
-                this_name_offset = res.name_offset - namelist_offset
-            attribs = int(res.obj.attribs)
-            this_data_offset = res.data_offset - data_offset
-            mixedfield = (attribs << 24) | this_data_offset
-            struct.pack_into('>hHL', accum, counter, res.obj.id, this_name_offset, mixedfield)
+                this_name_offset = len(accum) - namelist_offset
+                as_bytes = name.encode('mac_roman')
+                accum.append(len(as_bytes))
+                accum.extend(as_bytes)
+
+            mixedfield = (int(attribs) << 24) | this_data_offset
+            struct.pack_into('>hHL', accum, counter, rid, this_name_offset, mixedfield)
 
             counter += 12
 
     # all right, now populate the type list
     struct.pack_into('>H', accum, typelist_offset, (len(bigdict) - 1) & 0xFFFF)
     counter = typelist_offset + 2
+    firstref_offset = reflist_offset - typelist_offset
     for rtype, idlist in bigdict.items():
-        this_type = idlist[0].obj.type
-        ref_count = len(idlist)
-        firstref_offset = idlist[0].ref_offset - typelist_offset
-        struct.pack_into('>4sHH', accum, counter, this_type, ref_count - 1, firstref_offset)
+        struct.pack_into('>4sHH', accum, counter, rtype, len(idlist) - 1, firstref_offset)
 
+        firstref_offset += 12 * len(idlist)
         counter += 8
 
     # all right, now populate the map
-    struct.pack_into('>24xHH', accum, map_offset, typelist_offset - map_offset, namelist_offset - map_offset)
+    struct.pack_into('>24xHH', accum, 0, typelist_offset, namelist_offset)
 
-    # all right, now populate the header
-    data_len = map_offset - data_offset
-    map_len = len(accum) - map_offset
-    struct.pack_into('>LLLL', accum, 0, data_offset, map_offset, data_len, map_len)
+    # all right, now the header
+    header = bytearray(data_offset)
+    struct.pack_into('>LLLL', header, 0, data_offset, map_offset, data_len, len(accum))
 
-    return bytes(accum)
+    return header, accum
 
 
-def make_rez_code(from_iter, ascii_clean=False):
-    """Express an iterator of Resource objects as Rez code (bytes).
+@stats.instrument('write_file', source=1)
+def write_file(to_file, from_iter, align=1):
+    """Pack an iterator of Resource objects into a binary resource file object.
 
-    This will match the output of the deprecated Rez utility, unless the
-    `ascii_clean` argument is used to get a 7-bit-only code block.
+    The resource data is streamed to the file, so only one resource is
+    held in memory at a time. Seekable files get their header filled in
+    last. Otherwise `from_iter` is walked twice (and must be a sequence if
+    it is not to be copied into a list): once to lay out the map using the
+    resource lengths, and once more to write the data.
     """
 
+    try:
+        seekable = to_file.seekable()
+    except AttributeError:
+        seekable = False
+
+    bigdict = collections.OrderedDict() # maintain order of types, but manually order IDs
+
+    if seekable:
+        start = to_file.tell()
+        to_file.write(bytes(256)) # defer header
+
+        pos = 0
+        for r in from_iter:
+            pad = -(256 + pos) % align
+            if pad:
+                to_file.write(bytes(pad))
+                pos += pad
+
+            bigdict.setdefault(r.type, []).append((r.id, r.name, r.attribs, pos))
+            data = r.data
+            to_file.write(struct.pack('>L', len(data)))
+            to_file.write(data)
+            pos += 4 + len(data)
+
+        header, resmap = _make_map(bigdict, pos)
+        to_file.write(resmap)
+        end = to_file.tell()
+        to_file.seek(start)
+        to_file.write(header)
+        to_file.seek(end)
+
+    else:
+        if iter(from_iter) is from_iter:
+            from_iter = list(from_iter)
+
+        pos = 0
+        for r in from_iter:
+            pos += -(256 + pos) % align
+            bigdict.setdefault(r.type, []).append((r.id, r.name, r.attribs, pos))
+            pos += 4 + len(r.data)
+
+        header, resmap = _make_map(bigdict, pos)
+        to_file.write(header)
+
+        pos = 0
+        for r in from_iter:
+            pad = -(256 + pos) % align
+            if pad:
+                to_file.write(bytes(pad))
+                pos += pad
+
+            data = r.data
+            to_file.write(struct.pack('>L', len(data)))
+            to_file.write(data)
+            pos += 4 + len(data)
+
+        to_file.write(resmap)
+
+
+def make_file(from_iter, align=1):
+    """Pack an iterator of Resource objects into a binary resource file."""
+
+    accum = io.BytesIO()
+    write_file(accum, from_iter, align=align)
+    return accum.getvalue()
+
+
+def _rez_header(resource, ascii_clean):
+    """The 'data ... {' line that opens a resource's Rez code."""
+
+    args = []
+    args.append(str(resource.id).encode('ascii'))
+    if resource.name is not None:
+        args.append(_rez_escape(resource.name.encode('mac_roman'), singlequote=False, ascii_clean=ascii_clean))
+    args.extend(x.encode('ascii') for x in attribs_for_derez(resource.attribs))
+    args = b', '.join(args)
+
+    fourcc = _rez_escape(resource.type, singlequote=True, ascii_clean=ascii_clean)
+
+    return b'data %s (%s) {' % (fourcc, args)
+
+
+# One full line of a data block, before the hex and comment columns are filled in
+REZ_LINE = b'\t$"' + b' ' * 39 + b'"' + b' ' * 12 + b'/* ' + b' ' * 16 + b' */\n'
+
+# Where the two hex digits of each of the 16 bytes go in a line
+REZ_HEX_COLUMNS = [3 + 5 * (k // 2) + 2 * (k % 2) for k in range(16)]
+
+def _rez_short_line(overhang):
+    line = bytearray(REZ_LINE)
+    line[42] = ord(' ')
+    line[REZ_HEX_COLUMNS[15 - overhang] + 2] = ord('"') # close the hex literal after the last byte
+    return bytes(line[:75-overhang] + b'*/\n')
+
+# The last line of a data block, indexed by the number of bytes it is short of 16
+REZ_SHORT_LINES = [None] + [_rez_short_line(overhang) for overhang in range(1, 16)]
+
+# Rez code at least this long is rendered with NumPy, if it is installed
+# (NumPy is faster for any size of resource, but slow to import)
+REZ_NUMPY_BYTES = 0x100000
+
+
+def _rez_size(header, length):
+    """The exact length of a resource's Rez code, given its header line and data length."""
+
+    size = len(header) + 5 # '\n' + '};\n\n'
+    if length:
+        numlines = (length + 15) // 16
+        size += numlines * 78 - (numlines * 16 - length)
+    return size
+
+
+def _rez_comment_column(data, themap):
+    # Prevent star-slash from ending the comment column prematurely
+    def comment_end_fixer(m):
+        start, stop = m.span()
+        stop -= 1
+        if start & -16 == stop & -16:
+            return m.group()[:-1] + b'.'
+        else:
+            return m.group()
+    comment_column = re.sub(rb'\*[\x00-\x1F]{0,14}/', comment_end_fixer, data)
+    return comment_column.translate(themap)
+
+
+_numpy_hex_table = None
+
+def _numpy():
+    global _numpy_hex_table
+    np = optional.numpy()
+    if np and _numpy_hex_table is None:
+        # Four hex digits for each big-endian 16-bit word, as one uint32
+        pairs = np.frombuffer(b''.join(b'%02X' % i for i in range(256)), np.uint8).reshape(256, 2)
+        quads = np.empty((256, 256, 4), np.uint8)
+        quads[:, :, :2] = pairs[:, np.newaxis]
+        quads[:, :, 2:] = pairs[np.newaxis, :]
+        _numpy_hex_table = quads.view(np.uint32).reshape(65536)
+    return np
+
+
+# Without NumPy, lines are rendered this many at a time in a scratch buffer small enough to stay in cache
+REZ_SCRATCH_LINES = 2048
+
+def _render_rez_lines(out, pos, data, comment_column, fulllines):
+    """Fill in full lines of hex and comment in out[pos:], one column at a time."""
+
+    scratch = bytearray(REZ_LINE * min(fulllines, REZ_SCRATCH_LINES))
+    view = memoryview(scratch)
+
+    for first in range(0, fulllines, REZ_SCRATCH_LINES):
+        stop = min(first + REZ_SCRATCH_LINES, fulllines)
+        nbytes = (stop - first) * 78
+
+        # The hex inside the $"" literals
+        hex_column = binascii.hexlify(memoryview(data)[first*16:stop*16]).upper()
+        for i in range(8):
+            for j in range(4):
+                scratch[3+i*5+j:nbytes:78] = hex_column[i*4+j::32]
+
+        comment_part = comment_column[first*16:stop*16]
+        for i in range(16):
+            scratch[58+i:nbytes:78] = comment_part[i::16]
+
+        out[pos+first*78:pos+stop*78] = view[:nbytes]
+
+
+def _render_rez_lines_numpy(np, out, pos, data, comment_column, fulllines):
+    """Fill in full lines of hex and comment in out[pos:], as arrays."""
+
+    lines = np.ndarray((fulllines, 78), np.uint8, out, pos)
+    lines[:] = np.frombuffer(REZ_LINE, np.uint8)
+
+    # Eight groups of four hex digits per line, five bytes apart
+    words = np.frombuffer(data, '>u2', fulllines * 8)
+    groups = np.ndarray((fulllines, 8), np.uint32, out, pos + 3, (78, 5))
+    groups[:] = _numpy_hex_table[words].reshape(fulllines, 8)
+
+    lines[:, 58:74] = np.frombuffer(comment_column, np.uint8, fulllines * 16).reshape(fulllines, 16)
+
+
+def _render_rez_into(out, pos, header, data, themap, np=None):
+    """Write one resource's Rez code into a writable buffer at pos, returning the end position."""
+
+    out[pos:pos+len(header)] = header
+    pos += len(header)
+    out[pos] = 10 # '\n'
+    pos += 1
+
+    length = len(data)
+    if length:
+        fulllines, leftover = divmod(length, 16)
+        comment_column = _rez_comment_column(data, themap)
+
+        if fulllines:
+            if np:
+                _render_rez_lines_numpy(np, out, pos, data, comment_column, fulllines)
+            else:
+                _render_rez_lines(out, pos, data, comment_column, fulllines)
+            pos += fulllines * 78
+
+        if leftover:
+            line = REZ_SHORT_LINES[16 - leftover]
+            out[pos:pos+len(line)] = line
+            start = fulllines * 16
+            for k in range(leftover):
+                col = pos + REZ_HEX_COLUMNS[k]
+                out[col:col+2] = b'%02X' % data[start+k]
+            out[pos+58:pos+58+leftover] = comment_column[start:]
+            pos += len(line)
+
+    out[pos:pos+4] = b'};\n\n'
+    return pos + 4
+
+
+def _rez_source(resource, ascii_clean):
+    """Get the code that parse_rez_code kept for a resource, if the resource is unchanged since."""
+
+    try:
+        source, start, stop, is_ascii, fingerprint = resource._rez_source
+    except AttributeError:
+        return None
+
+    if ascii_clean and not is_ascii: return None
+    if _rez_fingerprint(resource) != fingerprint: return None
+
+    return memoryview(source)[start:stop]
+
+
+def _rez_ready(resource, ascii_clean, cache):
+    """Get a resource's code as a tuple of chunks if it needs no rendering, else None, and a cache key or None."""
+
+    source = _rez_source(resource, ascii_clean)
+    if source is not None:
+        return (source, b'\n\n'), None
+
+    if cache is None:
+        return None, None
+
+    key = cache.key(resource, ascii_clean)
+    code = cache.get(key)
+    if code is not None:
+        return (code,), None
+    return None, key
+
+
+def _render_rez(resources, ascii_clean, cache=None):
+    """Express an iterable of Resource objects as Rez code, in one exactly-sized buffer."""
+
     if ascii_clean:
         themap = CLEANMAP
     else:
         themap = MAP
 
-    lines = []
-    for resource in from_iter:
-        args = []
-        args.append(str(resource.id).encode('ascii'))
-        if resource.name is not None:
-            args.append(_rez_escape(resource.name.encode('mac_roman'), singlequote=False, ascii_clean=ascii_clean))
-        args.extend(x.encode('ascii') for x in attribs_for_derez(resource.attribs))
-        args = b', '.join(args)
+    # A header of None means the data is code to copy through, and a key means the code goes in the cache
+    jobs = []
+    for r in resources:
+        ready, key = _rez_ready(r, ascii_clean, cache)
+        if ready is None:
+            jobs.append((_rez_header(r, ascii_clean), r.data, key))
+        else:
+            jobs.extend((None, chunk, None) for chunk in ready)
+
+    rendered = sum(_rez_size(header, len(data)) for header, data, key in jobs if header is not None)
+    total = rendered + sum(len(data) for header, data, key in jobs if header is None)
+    np = rendered >= REZ_NUMPY_BYTES and _numpy()
+
+    # BytesIO.getvalue() hands back the buffer itself, so the result is not copied
+    accum = io.BytesIO(bytes(total))
+    with accum.getbuffer() as out:
+        pos = 0
+        for header, data, key in jobs:
+            start = pos
+            if header is None:
+                pos += len(data)
+                out[start:pos] = data
+            else:
+                pos = _render_rez_into(out, pos, header, data, themap, np)
+            if key is not None:
+                cache.put(key, bytes(out[start:pos]))
+    return accum.getvalue()
 
-        fourcc = _rez_escape(resource.type, singlequote=True, ascii_clean=ascii_clean)
 
-        lines.append(b'data %s (%s) {' % (fourcc, args))
+# Parallel rendering sends resources to the workers in batches of about this much data
+REZ_BATCH_BYTES = 0x100000
 
-        # Create a template bytearray
-        numlines = (len(resource) + 15) // 16
-        overhang = numlines * 16 - len(resource)
-        fulllines = numlines - bool(overhang)
-        fl_bytes = fulllines * 78
-        guts = numlines * bytearray(b'\t$"                                                    /*                    \n')
-        del guts[-1:] # no trailing newline
 
-        # The hex inside the $"" literals
-        hex_column = resource.hex().upper().encode('ascii')
-        if overhang:
-            hex_column += (2 * overhang) * b' '
+def _rez_batches(from_iter, ascii_clean, cache):
+    # Code that needs no rendering is passed through as bytes, and a batch comes with its cache keys
+    batch = []
+    keys = []
+    size = 0
+    for r in from_iter:
+        ready, key = _rez_ready(r, ascii_clean, cache)
+        if ready is not None:
+            if batch: yield batch, keys
+            batch = []
+            keys = []
+            size = 0
+            yield b''.join(ready)
+            continue
+
+        batch.append((r.type, r.id, r.name, r.attribs, bytes(r.data)))
+        keys.append(key)
+        size += len(r) + 64
+        if size >= REZ_BATCH_BYTES:
+            yield batch, keys
+            batch = []
+            keys = []
+            size = 0
+    if batch: yield batch, keys
+
+
+def _render_rez_batch(batch, ascii_clean):
+    # Each resource separately, so that the parent can cache them
+    return [_render_rez([ResourceView(*tup)], ascii_clean) for tup in batch]
+
+
+@stats.instrument('iter_rez_code', source=0)
+def iter_rez_code(from_iter, ascii_clean=False, workers=None, cache=None):
+    """Express an iterator of Resource objects as Rez code, yielding each
+    resource's code (bytes) as soon as it is rendered.
+
+    With a pool of `workers` processes, each chunk is a batch of resources,
+    and only a few batches are in flight at a time.
+    """
 
-        # Insert the hex column
-        for i in range(8):
-            for j in range(4):
-                guts[3+i*5+j::78] = hex_column[i*4+j::32]
-
-        # Close the hex literal
-        guts[42:fl_bytes:78] = b'"' * fulllines
-        if overhang: # slightly hacky -- searches for spaces!
-            guts[fl_bytes+guts[fl_bytes:].index(b'  ')] = ord('"')
-
-        # Prevent star-slash from ending the comment column prematurely
-        def comment_end_fixer(m):
-            start, stop = m.span()
-            stop -= 1
-            if start & -16 == stop & -16:
-                return m.group()[:-1] + b'.'
+    if workers is None or workers == 1:
+        for resource in from_iter:
+            yield _render_rez([resource], ascii_clean, cache)
+        return
+
+    import concurrent.futures
+    import os
+
+    in_flight = 2 * (workers or os.cpu_count() or 1)
+
+    def finish(future, keys):
+        code = future.result()
+        if keys is None: return code # passed through
+        if cache is not None:
+            for key, block in zip(keys, code):
+                cache.put(key, block)
+        return b''.join(code)
+
+    with concurrent.futures.ProcessPoolExecutor(workers or None) as pool:
+        window = collections.deque()
+        for batch in _rez_batches(from_iter, ascii_clean, cache):
+            if isinstance(batch, bytes):
+                done = concurrent.futures.Future()
+                done.set_result(batch)
+                window.append((done, None))
             else:
-                return m.group()
-        comment_column = re.sub(rb'\*[\x00-\x1F]{0,14}/', comment_end_fixer, resource)
-        comment_column = comment_column.translate(themap)
-        if overhang:
-            comment_column += overhang * b' '
+                batch, keys = batch
+                window.append((pool.submit(_render_rez_batch, batch, ascii_clean), keys))
+            if len(window) >= in_flight:
+                yield finish(*window.popleft())
+        while window:
+            yield finish(*window.popleft())
 
-        # Insert the comment column
-        for i in range(16):
-            guts[58+i::78] = comment_column[i::16]
 
-        # Close the comment
-        guts[75:fl_bytes:78] = b'*' * fulllines
-        guts[76:fl_bytes:78] = b'/' * fulllines
-        if overhang:
-            del guts[-overhang-2:]
-            guts.extend(b'*/')
+def write_rez_code(to_file, from_iter, ascii_clean=False, workers=None, cache=None):
+    """Stream Rez code for an iterator of Resource objects to a file object."""
 
-        if guts: lines.append(guts)
+    for chunk in iter_rez_code(from_iter, ascii_clean=ascii_clean, workers=workers, cache=cache):
+        to_file.write(chunk)
 
-        lines.append(b'};')
-        lines.append(b'')
-    if lines: lines.append(b'') # hack, because all posix lines end with a newline
 
-    return b'\n'.join(lines)
+@stats.instrument('make_rez_code', source=0)
+def make_rez_code(from_iter, ascii_clean=False, workers=None, cache=None):
+    """Express an iterator of Resource objects as Rez code (bytes).
+
+    This will match the output of the deprecated Rez utility, unless the
+    `ascii_clean` argument is used to get a 7-bit-only code block.
+
+    Resources can be rendered in parallel on a pool of `workers` processes
+    (0 meaning one per CPU). The output is the same.
+
+    Pass a macresources.cache.RenderCache as `cache` to reuse code already
+    rendered for identical resources.
+    """
+
+    if workers is None or workers == 1:
+        return _render_rez(from_iter, ascii_clean, cache)
+    else:
+        return b''.join(iter_rez_code(from_iter, ascii_clean, workers, cache))
+
+
+class ResourceFork:
+    """
+    An ordered collection of resources, indexed by (type, id) so that
+    lookups do not need a linear scan. Looking up by name only scans the
+    resources of one type, and always sees the current names. Iterating
+    yields the resources in order, so a ResourceFork can be passed
+    straight to make_file or make_rez_code.
+
+    Adding a resource with the same type and ID as an existing one
+    replaces it in place. The index is only updated by ResourceFork
+    methods, so to change the type or ID of a resource, remove it,
+    change it, then add it back. (remove still works after the change.)
+    """
+
+    def __init__(self, from_iter=()):
+        self._order = {} # (type, id): resource, in insertion order
+        self._types = {} # type: {id: resource}
+        self._keys = {} # id(resource): (type, id) it was added under
+
+        for r in from_iter:
+            self.add(r)
+
+    @classmethod
+    def from_file(cls, from_resfile, lazy=False):
+        """Build a ResourceFork from a binary resource file."""
+        return cls(parse_file(from_resfile, lazy=lazy))
+
+    @classmethod
+    def from_rez_code(cls, from_rezcode, original_file='<string>', keep_source=False):
+        """Build a ResourceFork from Rez code."""
+        return cls(parse_rez_code(from_rezcode, original_file=original_file, keep_source=keep_source))
+
+    def __repr__(self):
+        return '%s(<%d resources>)' % (self.__class__.__name__, len(self))
+
+    def __len__(self):
+        return len(self._order)
+
+    def __iter__(self):
+        return iter(self._order.values())
+
+    def __contains__(self, type_id):
+        return type_id in self._order
+
+    def __getitem__(self, type_id):
+        return self._order[type_id]
+
+    def __delitem__(self, type_id):
+        self.remove(self._order[type_id])
+
+    def get(self, type, id, default=None):
+        """Get the resource with this type and ID."""
+        return self._order.get((type, id), default)
+
+    def get_named(self, type, name, default=None):
+        """Get the first resource with this type and name."""
+        for r in self._types.get(type, {}).values():
+            if r.name == name:
+                return r
+        return default
+
+    def types(self):
+        """List the resource types present, in order of first appearance."""
+        return list(self._types)
+
+    def of_type(self, type):
+        """List the resources of one type, in order."""
+        return list(self._types.get(type, {}).values())
+
+    def add(self, resource):
+        """Insert a resource, or replace the one with the same type and ID."""
+        key = (resource.type, resource.id)
+        old = self._order.get(key)
+        if old is not None:
+            del self._keys[id(old)]
+
+        self._order[key] = resource
+        self._types.setdefault(resource.type, {})[resource.id] = resource
+        self._keys[id(resource)] = key
+
+    def remove(self, resource):
+        """Remove a resource (KeyError if absent)."""
+        key = self._keys.get(id(resource))
+        if key is None or self._order.get(key) is not resource:
+            raise KeyError((resource.type, resource.id))
+
+        type, rid = key
+        del self._order[key]
+        del self._keys[id(resource)]
+        same_type = self._types[type]
+        del same_type[rid]
+        if not same_type:
+            del self._types[type]
@@ -0,0 +1,236 @@
+# Copyright (c) 2018-2020 Elliot Nunn
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Per-stage timings for finding out where a slow run spends its time.
+
+Set MACRESOURCES_STATS=1 (or pass --stats to a command-line tool) to get
+one line of JSON on stderr at exit, or set MACRESOURCES_STATS to a file
+name to append the line there instead. For each stage it holds the
+number of calls, the seconds spent, the bytes in and out and the number
+of resources. Time spent pulling resources from another stage (e.g. a
+parse_file iterator passed to make_rez_code) is not counted twice, and
+"other_seconds" is whatever was left, such as file I/O.
+
+When disabled, an instrumented function costs one extra call.
+"""
+
+
+import atexit
+import functools
+import json
+import os
+import sys
+import time
+
+
+enabled = False
+
+_stages = {} # stage: [calls, seconds, bytes_in, bytes_out, resources]
+_depth = 0 # calls nested inside an instrumented call are not recorded separately
+_started = time.perf_counter()
+_dest = None
+
+
+def _size(obj):
+    try:
+        return memoryview(obj).nbytes
+    except TypeError:
+        try:
+            return len(obj)
+        except TypeError:
+            return 0
+
+
+def record(stage, seconds, bytes_in=0, bytes_out=0, resources=0, calls=1):
+    """Add to the totals for a stage (only when enabled)."""
+
+    if not enabled: return
+
+    totals = _stages.get(stage)
+    if totals is None:
+        totals = _stages[stage] = [0, 0.0, 0, 0, 0]
+    totals[0] += calls
+    totals[1] += seconds
+    totals[2] += bytes_in
+    totals[3] += bytes_out
+    totals[4] += resources
+
+
+class _Source:
+    # Counts the resources pulled from an iterator, and the time spent waiting for them
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+        self.seconds = 0.0
+        self.bytes = 0
+        self.resources = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        global _depth
+
+        # Whatever the iterator calls is not nested in the consumer's own work
+        depth = _depth
+        _depth = 0
+        start = time.perf_counter()
+        try:
+            item = next(self.iterator)
+        finally:
+            self.seconds += time.perf_counter() - start
+            _depth = depth
+        self.bytes += _size(item)
+        self.resources += 1
+        return item
+
+
+def _timed_iter(stage, iterator, bytes_in, source, seconds):
+    # Time each step of an iterator, and record the totals when it finishes or is dropped
+    global _depth
+
+    bytes_out = resources = 0
+    try:
+        while True:
+            start = time.perf_counter()
+            _depth += 1
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                _depth -= 1
+                seconds += time.perf_counter() - start
+            bytes_out += _size(item)
+            resources += 1
+            yield item
+    finally:
+        if source is not None:
+            seconds -= source.seconds
+            bytes_in += source.bytes
+            resources = source.resources
+        record(stage, seconds, bytes_in, bytes_out, resources)
+
+
+def instrument(stage, data=None, source=None):
+    """Decorate a function to record its calls as a stage.
+
+    `data` is the position of an argument counted as bytes in, and
+    `source` the position of an argument that is an iterator of
+    resources. The result counts as bytes out, unless it is an iterator,
+    in which case each item counts as a resource.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            global _depth
+
+            if not enabled or _depth:
+                return func(*args, **kwargs)
+
+            bytes_in = 0
+            if data is not None and len(args) > data:
+                bytes_in = _size(args[data])
+
+            counter = None
+            if source is not None and len(args) > source:
+                counter = _Source(args[source])
+                args = args[:source] + (counter,) + args[source+1:]
+
+            start = time.perf_counter()
+            _depth += 1
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                _depth -= 1
+            seconds = time.perf_counter() - start
+
+            if hasattr(result, '__next__'): # a generator or other iterator
+                return _timed_iter(stage, result, bytes_in, counter, seconds)
+
+            resources = 1
+            if counter is not None:
+                seconds -= counter.seconds
+                bytes_in += counter.bytes
+                resources = counter.resources
+            record(stage, seconds, bytes_in, _size(result), resources)
+            return result
+
+        return wrapper
+    return decorator
+
+
+def report():
+    """Get the totals so far as a dict, in the form dumped at exit."""
+
+    stages = {}
+    accounted = 0.0
+    for stage, (calls, seconds, bytes_in, bytes_out, resources) in sorted(_stages.items()):
+        stages[stage] = dict(calls=calls, seconds=round(seconds, 6),
+            bytes_in=bytes_in, bytes_out=bytes_out, resources=resources)
+        accounted += seconds
+
+    wall = time.perf_counter() - _started
+    return dict(argv=sys.argv, pid=os.getpid(), seconds=round(wall, 6),
+        other_seconds=round(max(wall - accounted, 0.0), 6), stages=stages)
+
+
+def _dump():
+    if _dest is None: return
+
+    line = json.dumps(report(), sort_keys=True) + '\n'
+    if _dest in ('1', '-', 'stderr'):
+        sys.stderr.write(line)
+        sys.stderr.flush()
+    else:
+        with open(_dest, 'a') as f:
+            f.write(line)
+
+
+def enable(dest='-'):
+    """Start recording, and dump the totals at exit to stderr ('-') or
+    appended to the named file. A `dest` of None dumps nothing."""
+
+    global enabled, _dest
+
+    if not enabled:
+        _stages.clear()
+    enabled = True
+
+    _dest = dest
+    atexit.unregister(_dump) # only once
+    atexit.register(_dump)
+
+
+def disable():
+    """Stop recording and forget the totals (nothing is dumped at exit)."""
+
+    global enabled, _dest
+
+    enabled = False
+    _stages.clear()
+    _dest = None
+    atexit.unregister(_dump)
+
+
+if os.environ.get('MACRESOURCES_STATS', '0') != '0':
+    enable(os.environ['MACRESOURCES_STATS'])
@@ -18,5 +18,6 @@ setup(
         'Development Status :: 3 - Alpha',
     ],
     packages=['macresources'],
+    extras_require={'numpy': ['numpy']},
     scripts=['bin/SimpleRez', 'bin/SimpleDeRez', 'bin/hexrez', 'bin/rezhex', 'bin/sortrez', 'bin/rfx', 'bin/greggybits', 'bin/instacomp'],
 )
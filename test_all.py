@@ -1,4 +1,5 @@
 from macresources import *
+from macresources.main import RezSyntaxError
 
 RF = b'\x00\x00\x01\x00\x00\x00\x01\x08\x00\x00\x00\x08\x00\x00\x00;\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x04\x124Vx\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x1c\x002\x00\x00elmo\x00\x00\x00\n\x00{\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x08lamename'
 RZF = b"""
@@ -33,3 +34,460 @@ def test_make_rez_code():
 
     rez = make_rez_code(l)
     assert b'1234 5678' in rez
+
+def test_parse_file_lazy():
+    src = bytearray(RF)
+    l = list(parse_file(memoryview(src), lazy=True))
+
+    assert l[0].type == b'elmo'
+    assert l[0].name == 'lamename'
+    assert l[0].data == b'\x12\x34\x56\x78'
+    assert make_file(l) == make_file(parse_file(RF))
+    assert make_rez_code(l) == make_rez_code(parse_file(RF))
+
+    l[0][0] = 0xFF # copy-on-write
+    assert l[0].data == b'\xFF\x34\x56\x78'
+    assert src == RF
+
+def test_resource_view_drop_in():
+    import io, sys
+    r = next(parse_file(RF, lazy=True))
+
+    assert isinstance(r, Resource)
+    assert b'\x56' in r and b'\x99' not in r and 0x34 in r
+    assert r.find(b'\x56\x78') == 2 and r.index(b'\x78') == 3
+    assert r.hex() == '12345678' and r.startswith((b'\x00', b'\x12'))
+    assert r + b'!' == b'\x12\x34\x56\x78!' and b'!' + r == b'!\x12\x34\x56\x78'
+    assert r * 2 == bytes(r) * 2 and r < b'\x13'
+
+    f = io.BytesIO()
+    if sys.version_info >= (3, 12):
+        f.write(r) # the buffer protocol
+    else:
+        try:
+            f.write(r)
+        except TypeError:
+            f.write(r.data) # fails loudly, never writes nothing
+        else:
+            assert False
+    assert f.getvalue() == b'\x12\x34\x56\x78'
+
+    r.insert(0, 0)
+    assert r.pop() == 0x78 and r == b'\x00\x12\x34\x56'
+    r.reverse(); r.remove(0)
+    assert r.data == b'\x56\x34\x12'
+
+def test_resource_fork():
+    fork = ResourceFork.from_file(RF)
+
+    assert fork.get(b'elmo', 123).name == 'lamename'
+    assert fork.get_named(b'elmo', 'lamename').id == 123
+    assert (b'elmo', 123) in fork
+    assert make_file(fork) == make_file(parse_file(RF))
+
+    fork.add(Resource(b'elmo', 123, data=b'new'))
+    assert len(fork) == 1
+    assert fork.get_named(b'elmo', 'lamename') is None
+    assert fork[b'elmo', 123] == b'new'
+
+    fork.add(Resource(b'STR ', 0))
+    assert fork.types() == [b'elmo', b'STR ']
+    del fork[b'elmo', 123]
+    assert fork.types() == [b'STR ']
+    assert [r.id for r in fork.of_type(b'STR ')] == [0]
+
+def test_resource_fork_rename():
+    fork = ResourceFork([Resource(b'STR ', 1, name='a'), Resource(b'STR ', 2, name='c')])
+    r = fork.get(b'STR ', 1)
+    r.name = 'b'
+    assert fork.get_named(b'STR ', 'b') is r
+    assert fork.get_named(b'STR ', 'a') is None
+
+    r.id = 5 # remove finds it where it was added
+    fork.remove(r)
+    assert len(fork) == 1 and fork.get(b'STR ', 1) is None
+    try:
+        fork.remove(r)
+    except KeyError:
+        pass
+    else:
+        assert False
+
+def test_write_file():
+    class Unseekable:
+        def __init__(self):
+            self.written = bytearray()
+
+        def write(self, data):
+            self.written.extend(data)
+
+    l = list(parse_file(RF))
+    for align in (1, 2, 3):
+        f = Unseekable()
+        write_file(f, iter(l), align=align)
+        assert f.written == make_file(l, align=align)
+
+def test_parse_rez_stream():
+    import io
+
+    rez = make_rez_code(parse_file(RF)) * 3
+    rez = rez.replace(b'\n', b'\r\n')
+    for chunk_size in (1, 2, 3, 50, 1000):
+        l = list(parse_rez_stream(io.BytesIO(rez), chunk_size=chunk_size))
+        assert len(l) == 3
+        assert l[2].data == b'\x12\x34\x56\x78'
+        assert l[2].name == 'lamename'
+
+def test_parse_rez_empty_hex():
+    from macresources.main import RezSyntaxError
+
+    for empty in (b'$""', b'$"  "'):
+        try:
+            list(parse_rez_code(b'data \'TEST\' (1) {\n\t' + empty + b'\n};\n'))
+        except RezSyntaxError:
+            pass
+        else:
+            assert False
+
+def test_parse_rez_fast_hex():
+    # The bulk hex scanner must agree with the regex tokenizer
+    from macresources.main import _parse_rez, _RezReader, RezSyntaxError
+
+    def parse(code, fast_hex):
+        try:
+            return [(r.type, r.id, bytes(r)) for r in _parse_rez(_RezReader(code), '', 1000, fast_hex=fast_hex)]
+        except RezSyntaxError as e:
+            return str(e)
+
+    tricky = [b'', b'*/*/', b'}; data', bytes(range(256)), b'\n' * 40, b'x' * 33]
+    for ascii_clean in (False, True):
+        code = make_rez_code([Resource(b'TEST', i, data=d) for i, d in enumerate(tricky)], ascii_clean=ascii_clean)
+        variants = [code, code.replace(b'A', b'a'), code.replace(b' /*', b'/*'), code.replace(b'.', b'\n'), code.replace(b'00', b'0 0')]
+        for v in variants:
+            assert parse(v, True) == parse(v, False)
+
+def test_rez_syntax_error_position():
+    bad = RZF + b'\ndata \'elmo\' (124) {\n    $"12"  ?\n};\n'
+    try:
+        list(parse_rez_code(bad, original_file='bad.r'))
+    except RezSyntaxError as e:
+        assert (e.filename, e.line, e.column) == ('bad.r', 5, 12)
+        assert bad[e.offset:e.offset+1] == b'?'
+    else:
+        assert False
+
+    errors = validate_rez_code(bad + RZF + bad.replace(b'(124)', b'(99999)') + b'data')
+    assert [e.line for e in errors] == [5, 12, 15]
+    assert 'ID out of 16-bit range' in errors[1].msg
+    assert 'unexpected end of file' in errors[2].msg
+
+def test_make_rez_code_workers():
+    l = list(parse_file(RF)) * 5
+    assert make_rez_code(l, workers=2) == make_rez_code(l)
+
+def test_make_rez_code_layout():
+    from macresources import main
+
+    assert make_rez_code([Resource(b'TEST', 3, data=b'\x12\x34\x56')]) == \
+        b'data \'TEST\' (3) {\n\t$"1234 56"                                            /* .4V */\n};\n\n'
+
+    # Every short-line length, and more lines than fit in the scratch buffer
+    l = [Resource(b'TEST', n, data=bytes(range(256))[-n:]) for n in range(50)] + [Resource(b'BIG ', 1, data=bytes(range(256)) * 300)]
+    rez = make_rez_code(l)
+    clean = make_rez_code(l, ascii_clean=True)
+    assert [bytes(r) for r in parse_rez_code(rez)] == [bytes(r) for r in l]
+
+    # NumPy, if installed, must render the same
+    saved = main.REZ_NUMPY_BYTES
+    main.REZ_NUMPY_BYTES = 0
+    try:
+        assert make_rez_code(l) == rez
+        assert make_rez_code(l, ascii_clean=True) == clean
+    finally:
+        main.REZ_NUMPY_BYTES = saved
+
+def test_write_rez_code():
+    import io
+    l = list(parse_file(RF)) * 3
+    assert list(iter_rez_code(l)) == [make_rez_code([r]) for r in l]
+    for workers in (None, 2):
+        f = io.BytesIO()
+        write_rez_code(f, l, ascii_clean=True, workers=workers)
+        assert f.getvalue() == make_rez_code(l, ascii_clean=True)
+
+def test_resource_compact():
+    a, b = parse_file(make_file([Resource(b'elmo', 1, 'caf\xe9'), Resource(b'elmo', 2, data=b'xyz')]))
+    assert a.type is b.type # interned
+    assert a.name == 'caf\xe9' and b.name is None
+    assert not hasattr(a, '__dict__') or not a.__dict__
+
+    b.extend(b'!')
+    b.custom = 1 # arbitrary attributes still work
+    assert b == b'xyz!' and b.custom == 1
+    assert isinstance(b, bytearray)
+
+def test_parse_rez_code_keep_source():
+    code = b'data \'elmo\' (1) {\n  $"0102"  // hand-written\n};\n\ndata \'elmo\' (2, "caf\x8e") {\n\t$"03"\n};\n\n'
+    l = list(parse_rez_code(code, keep_source=True))
+
+    for workers in (None, 2):
+        assert make_rez_code(l, workers=workers) == code # copied through verbatim
+
+    # Code that is not 7-bit clean cannot be kept for ascii_clean output
+    first = code[:code.index(b'data', 1)]
+    assert make_rez_code(l, ascii_clean=True) == first + make_rez_code([Resource(b'elmo', 2, 'caf\xe9', data=b'\x03')], ascii_clean=True)
+
+    l[1].data = b'\x04'
+    assert make_rez_code(l).startswith(b'data \'elmo\' (1) {\n  $"0102"  // hand-written\n};\n\n')
+    assert list(parse_rez_code(make_rez_code(l)))[1] == b'\x04'
+
+def test_render_cache():
+    import tempfile
+    l = [Resource(b'elmo', i, data=bytes(range(i * 10))) for i in range(10)]
+    rez = make_rez_code(l)
+
+    cache = RenderCache()
+    assert make_rez_code(l, cache=cache) == rez
+    assert (cache.hits, cache.misses) == (0, 10)
+    assert make_rez_code(l, cache=cache) == rez
+    assert make_rez_code(l, ascii_clean=True, cache=cache) == make_rez_code(l, ascii_clean=True)
+    assert (cache.hits, cache.misses) == (10, 20)
+
+    small = RenderCache(max_bytes=1000)
+    assert make_rez_code(l, cache=small) == rez
+    assert small.evictions and small._size <= 1000
+
+    with tempfile.TemporaryDirectory() as d:
+        make_rez_code(l, cache=RenderCache(directory=d))
+        cache = RenderCache(directory=d)
+        assert make_rez_code(l, workers=2, cache=cache) == rez
+        assert cache.disk_hits == 10
+
+def test_stats():
+    from macresources import stats, greggybits
+    stats.enable(None)
+    try:
+        rez = make_rez_code(parse_file(RF))
+        greggybits.pack(bytes(100))
+
+        stages = stats.report()['stages']
+        assert stages['parse_file']['bytes_in'] == len(RF)
+        assert stages['parse_file']['resources'] == stages['make_rez_code']['resources'] == 1
+        assert stages['make_rez_code']['bytes_out'] == len(rez)
+        assert stages['greggybits.pack']['calls'] == 1 and 'greggybits.unpack' not in stages # nested
+    finally:
+        stats.disable()
+    assert not stats.report()['stages']
+
+def test_greggybits_unpack():
+    import random, struct
+    from macresources import greggybits
+    rng = random.Random(1)
+    common = greggybits.TABLE[:40]
+    for n in (18, 19, 100, 1001, 4096):
+        words = [rng.choice(common) if rng.random() < 0.8 else rng.randrange(0x10000) for i in range(n // 2)]
+        src = struct.pack('>%dH' % len(words), *words) + bytes(n & 1)
+        for flags in (1, 2, 3):
+            try:
+                packed = greggybits.pack_with_flags(src, flags)
+            except (KeyError, ValueError):
+                continue # this mode cannot express these words
+            assert greggybits.unpack(packed) == greggybits._unpack_reference(packed) == src
+            assert greggybits._slop_from_bitmaps(packed) == greggybits.unpack(packed, _calculate_slop=True)
+            greggybits.GREGGY_NUMPY_BYTES, old = 0, greggybits.GREGGY_NUMPY_BYTES
+            try:
+                assert greggybits.unpack(packed) == src
+            finally:
+                greggybits.GREGGY_NUMPY_BYTES = old
+
+    # Bad data raises the same errors as the reference decoder
+    packed = greggybits.pack_with_flags(bytes(range(100)) * 4, 3)
+    packed[-1] = 0xFF # an index past the end of the short table
+    for bad in (packed, packed[:-5]):
+        for decoder in (greggybits.unpack, greggybits._unpack_reference):
+            try:
+                decoder(bad)
+            except IndexError:
+                pass
+            else:
+                assert False
+
+def test_greggybits_pack():
+    import random, struct
+    from macresources import greggybits
+    rng = random.Random(2)
+    for n in (17, 18, 101, 600, 5000):
+        for distinct in (3, 200, 1000):
+            pool = [rng.randrange(0x10000) for i in range(distinct)] + list(greggybits.TABLE[:distinct])
+            src = struct.pack('>%dH' % (n // 2), *(rng.choice(pool) for i in range(n // 2))) + bytes(n & 1)
+
+            # The planner agrees with encoding every mode and keeping the first smallest
+            best = src
+            for flags in (0, 1, 2, 3):
+                try:
+                    candidate = greggybits.pack_with_flags(src, flags)
+                except (KeyError, ValueError):
+                    continue
+                if len(candidate) < len(best): best = candidate
+            assert greggybits.pack(src) == best
+            if best is not src: assert greggybits.unpack(best) == src
+
+def test_greggybits_resources():
+    from macresources import greggybits
+    code = bytes(range(64)) * 20
+    fork = ResourceFork([Resource(b'CODE', 1, data=code), Resource(b'STR ', 2, data=b'short'), Resource(b'CODE', 3, attribs=0x20, data=code)])
+
+    report = greggybits.pack_resources(fork, workers=2)
+    assert (report['packed'], report['incompressible'], report['bytes_in']) == (2, 1, 2 * len(code) + 5)
+    assert fork.get(b'CODE', 3).attribs == 0x21 and fork.get(b'STR ', 2).attribs == 0
+
+    assert [outcome for r, outcome in greggybits.verify_resources(fork)] == ['good', 'good']
+
+    report = greggybits.unpack_resources(fork)
+    assert (report['unpacked'], report['skipped']) == (2, 1)
+    assert fork.get(b'CODE', 3) == code and fork.get(b'CODE', 3).attribs == 0x20
+
+def test_instacomp_unpack():
+    import hashlib
+    from macresources import instacomp
+    packed = bytes.fromhex('a89f657200120901000001960003000000003ff349b9b9b9b34349b9b34349b9b349b9b34349b9b3434349b34349b9b9b34349b349b34349b34343434349b9b34349b9b9b343434349b9b9b349b34349b3434ef324ed47b06d4f4b4326936686937a5835d9a5f0b6dc3c84c271336fbcdb8159dda1beecbdff29ac5796a15a27489bd5f0c8362bc6cfe26800')
+    unpacked = instacomp.unpack(packed)
+    assert len(unpacked) == 406 and hashlib.md5(unpacked).hexdigest() == 'b1c15f812cc499864b411b47ef12e189'
+
+    try:
+        instacomp.unpack(packed[:100])
+    except IndexError:
+        pass
+    else:
+        assert False
+
+
+def test_unpacked():
+    from macresources import dcmp, greggybits, instacomp
+    data = b'hello world hello world hello hello hello world ' * 50
+    resources = [
+        Resource(b'CODE', 1, attribs=1, data=greggybits.pack(data)),
+        Resource(b'CODE', 2, attribs=1, data=instacomp.pack(data)),
+        Resource(b'CODE', 3, attribs=0, data=data),
+    ]
+    assert [dcmp.dcmp_number(r) for r in resources] == [2, 3, None]
+
+    cache = DecompressCache(max_bytes=len(data))
+    lazy = list(parse_file(make_file(resources), lazy=True))
+    for r in lazy:
+        assert r.unpacked(cache) == data
+    assert (cache.hits, cache.misses, cache.evictions) == (0, 2, 1)
+    assert resources[1].unpacked(cache) is resources[1].unpacked(cache)
+    assert (cache.hits, cache.misses) == (2, 2) # the same data as before
+    digest = resources[1]._packed_digest
+    resources[1].unpacked(cache)
+    assert resources[1]._packed_digest is digest # hashed only once
+
+    # Not stale after a change, however it is made
+    resources[1].data = instacomp.pack(data[::-1])
+    assert resources[1].unpacked(cache) == data[::-1]
+    resources[1][-1:] = b''
+    resources[1] += instacomp.pack(data[::-1])[-1:]
+    assert resources[1]._packed_digest is None
+    lazy[1][:] = greggybits.pack(data[::-1])
+    assert lazy[1].unpacked(cache) == data[::-1]
+
+    try:
+        dcmp.unpack(bytes.fromhex('a89f657200120901000000100009') + bytes(8))
+    except dcmp.UnknownDcmpError:
+        pass
+    else:
+        assert False
+
+
+def test_instacomp_pack():
+    import random
+    from macresources import instacomp
+    rng = random.Random(21)
+    words = [b'MOVE', b'LINK', b'RTS ', b'\x4e\x75', b'\x00\x00', b'JSR']
+    data = b''.join(rng.choice(words) for i in range(4000)) # past the last position with distance codes
+    for level in instacomp.LEVELS:
+        for n in (0, 5, 21, 22, 100, 1000, len(data)):
+            src = data[:n]
+            packed = instacomp.pack(src, level)
+            if n >= 100:
+                assert len(packed) < n
+            if packed is not src:
+                assert instacomp.unpack(packed) == src
+
+    assert instacomp.unpack(instacomp.pack(bytes(500))) == bytes(500)
+    noise = bytes(rng.randrange(256) for i in range(300))
+    assert instacomp.pack(noise) is noise
+
+def test_binhex():
+    import io, os, random, tempfile
+    from macresources import binhex
+
+    class KeepOpen(io.BytesIO):
+        def close(self): pass
+
+    # Escapes, runs and runs of the escape byte itself, which the decoder must not split wrongly
+    rng = random.Random(23)
+    data = rng.randbytes(5000) + b'\x90' * 300 + b'Q' + b'A' * 144 + b'\x00' * 1000 + b'x\x90\x90y' * 500
+    runs = b''.join(rng.choice([b'\x90', b'A']) * rng.randrange(1, 400) for i in range(500))
+    rsrc = make_file([Resource(b'STR ', 128, data=data[::-1]), Resource(b'RUNS', 128, data=runs)])
+
+    def chunks(b):
+        pos = 0
+        while pos < len(b):
+            n = rng.randrange(1, 700)
+            yield b[pos:pos+n]
+            pos += n
+
+    finfo = binhex.FInfo()
+    finfo.Type, finfo.Creator = b'TEXT', b'ttxt'
+    out = KeepOpen()
+    bh = binhex.BinHex(('Test', finfo, len(data), len(rsrc)), out)
+    for chunk in chunks(data): bh.write(chunk)
+    for chunk in chunks(rsrc): bh.write_rsrc(chunk)
+    bh.close()
+    hexed = out.getvalue()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        name = os.path.join(tmp, 'Test.hqx')
+        with open(name, 'wb') as f:
+            f.write(hexed)
+
+        for src in [name, open(name, 'rb'), io.BytesIO(hexed), hexed, bytearray(hexed), memoryview(hexed)]:
+            hb = binhex.HexBin(src)
+            assert hb.FName == b'Test' and hb.FInfo.Type == b'TEXT'
+            assert b''.join(iter(lambda: hb.read(rng.randrange(1, 700)), b'')) == data
+            assert hb.read_rsrc() == rsrc
+            hb.close()
+
+    try:
+        hb = binhex.HexBin(hexed[:-100])
+        hb.read()
+        hb.read_rsrc()
+    except binhex.Error:
+        pass
+    else:
+        assert False
+
+def test_hqx():
+    import binascii
+    from macresources import hqx
+    assert hqx.b2a_hqx(b'\x00\x00\x00\xff') == b'!!!!r`'
+    assert hqx.a2b_hqx(b'!!!!\nr`:') == (b'\x00\x00\x00\xff', 1)
+    assert hqx.rlecode_hqx(b'AAAA\x90BBB' + b'C' * 300) == b'A\x90\x04\x90\x00BBBC\x90\xffC\x90\x2d'
+    assert hqx.rledecode_hqx(b'A\x90\x04\x90\x00\x90\x03B') == b'AAAA\x90\x90\x90B'
+
+    for bad, exc in [(b'!!!', binascii.Incomplete), (b'!!!~', binascii.Error)]:
+        try:
+            hqx.a2b_hqx(bad)
+        except exc:
+            pass
+        else:
+            assert False
+    for bad, exc in [(b'A\x90', binascii.Incomplete), (b'\x90\x04', binascii.Error)]:
+        try:
+            hqx.rledecode_hqx(bad)
+        except exc:
+            pass
+        else:
+            assert False